@@ -0,0 +1,121 @@
+"""
+Read-through caching of the message content needed to send messages.
+
+Content is cached in this process for MESSAGE_CONTENT_LOCAL_TTL seconds and
+in the shared Django cache (see CACHES) for MESSAGE_CONTENT_CACHE_TTL seconds.
+Saving or deleting a Message or BinaryContent drops the affected shared
+entries, and again when the change commits; other processes pick up the
+change when their local entry expires.
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q
+
+from .models import Message
+
+_local = {}
+
+
+def message_content_key(messageset_id, sequence_number, lang):
+    return "message_content:%s:%s:%s" % (messageset_id, sequence_number, lang)
+
+
+def _content(message):
+    binary_content_url = None
+    if message.binary_content is not None:
+        binary_content_url = message.binary_content.content.url
+    return {
+        "id": message.id,
+        "text_content": message.text_content,
+        "binary_content_url": binary_content_url,
+    }
+
+
+def _get_local(key, now):
+    entry = _local.get(key)
+    if entry is not None and entry[0] > now:
+        return entry[1]
+    return None
+
+
+def _set_local(key, content, now):
+    _local[key] = (now + settings.MESSAGE_CONTENT_LOCAL_TTL, content)
+
+
+def get_message_contents(keys):
+    """ Returns the content for each (messageset_id, sequence_number, lang)
+        in keys that has a message, with all the cache misses loaded in one
+        query
+    """
+    now = time.time()
+    contents = {}
+    missing = []
+    for key in set(keys):
+        content = _get_local(message_content_key(*key), now)
+        if content is not None:
+            contents[key] = content
+        else:
+            missing.append(key)
+
+    if missing:
+        cached = cache.get_many(
+            [message_content_key(*key) for key in missing])
+        for key in missing:
+            content = cached.get(message_content_key(*key))
+            if content is not None:
+                contents[key] = content
+                _set_local(message_content_key(*key), content, now)
+        missing = [key for key in missing if key not in contents]
+
+    if missing:
+        query = Q()
+        for messageset_id, sequence_number, lang in missing:
+            query |= Q(messageset_id=messageset_id,
+                       sequence_number=sequence_number, lang=lang)
+        loaded = {}
+        messages = Message.objects.filter(query).select_related(
+            'binary_content')
+        for message in messages:
+            key = (message.messageset_id, message.sequence_number,
+                   message.lang)
+            contents[key] = loaded[message_content_key(*key)] = \
+                _content(message)
+            _set_local(message_content_key(*key), contents[key], now)
+        cache.set_many(loaded, settings.MESSAGE_CONTENT_CACHE_TTL)
+
+    return contents
+
+
+def get_message_content(messageset_id, sequence_number, lang):
+    """ Returns the id, text_content and binary_content_url of a message.
+        Raises Message.DoesNotExist if there is no such message.
+    """
+    key = (messageset_id, sequence_number, lang)
+    contents = get_message_contents([key])
+    if key not in contents:
+        raise Message.DoesNotExist(
+            "No message %s in %s for messageset %s" % (
+                sequence_number, lang, messageset_id))
+    return contents[key]
+
+
+def invalidate_message_content(messageset_id, sequence_number, lang):
+    """ Drops the cached content of a message, now and again once the
+        current transaction commits, so that content another process cached
+        from before the commit is not kept
+    """
+    key = message_content_key(messageset_id, sequence_number, lang)
+
+    def drop():
+        _local.pop(key, None)
+        cache.delete(key)
+
+    drop()
+    transaction.on_commit(drop)
+
+
+def clear_local():
+    _local.clear()
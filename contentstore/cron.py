@@ -0,0 +1,162 @@
+"""
+Next fire time calculation for schedules.
+
+Each Schedule is parsed once into a CronSchedule, which keeps the hours and
+minutes as sorted tuples and the days, weekdays and months as bitmasks. They
+are cached per schedule id for the life of the process. Times are worked out
+in UTC, like the scheduler's. A cached entry is
+dropped when its schedule is saved or deleted, and is also rebuilt if the
+cron string it was built from no longer matches, so other processes pick up
+changes on their next lookup.
+"""
+import threading
+from bisect import bisect_left
+from datetime import datetime, timedelta
+
+from django.utils import timezone
+
+CRON_NAMES = {
+    "sun": 0, "mon": 1, "tue": 2, "wed": 3, "thu": 4, "fri": 5, "sat": 6,
+    "jan": 1, "feb": 2, "mar": 3, "apr": 4, "may": 5, "jun": 6,
+    "jul": 7, "aug": 8, "sep": 9, "oct": 10, "nov": 11, "dec": 12,
+}
+
+# How far ahead to look before deciding a schedule never fires (Feb 30th)
+SEARCH_DAYS = 366 * 5
+
+_compiled = {}
+
+
+def parse_cron_field(field, minimum, maximum):
+    """ Returns the set of values a cron field matches, supporting *, single
+        values, ranges, steps, lists and day and month names
+    """
+    def value(s):
+        s = s.lower()
+        return CRON_NAMES[s] if s in CRON_NAMES else int(s)
+
+    values = set()
+    for part in str(field).replace(' ', '').split(','):
+        step = 1
+        if '/' in part:
+            part, step = part.split('/')
+            step = int(step)
+        if part in ('*', ''):
+            start, end = minimum, maximum
+        elif '-' in part:
+            start, end = [value(v) for v in part.split('-')]
+        else:
+            start = value(part)
+            end = maximum if step > 1 else start
+        if start < minimum or end > maximum or start > end or step < 1:
+            raise ValueError("Invalid cron field: %s" % field)
+        values.update(range(start, end + 1, step))
+    return values
+
+
+def bitmask(values):
+    mask = 0
+    for value in values:
+        mask |= 1 << value
+    return mask
+
+
+class CronSchedule(object):
+
+    """ A parsed cron string. Follows standard cron, like the scheduler: if
+        both day of month and day of week are restricted, a day matching
+        either one fires.
+    """
+
+    def __init__(self, cron_string):
+        minute, hour, day_of_week, day_of_month, month_of_year = \
+            cron_string.split()
+        self.cron_string = cron_string
+        self.minutes = tuple(sorted(parse_cron_field(minute, 0, 59)))
+        self.hours = tuple(sorted(parse_cron_field(hour, 0, 23)))
+        self.days_of_month = bitmask(parse_cron_field(day_of_month, 1, 31))
+        self.months = bitmask(parse_cron_field(month_of_year, 1, 12))
+        days_of_week = parse_cron_field(day_of_week, 0, 7)
+        if 7 in days_of_week:
+            days_of_week.add(0)
+        self.days_of_week = bitmask(days_of_week)
+        self.either_day = not (day_of_month.startswith('*') or
+                               day_of_week.startswith('*'))
+        # The last answer in each thread, which holds for any time from the
+        # minute asked about up to the answer itself
+        self._memo = threading.local()
+
+    def day_matches(self, day):
+        dom = self.days_of_month >> day.day & 1
+        dow = self.days_of_week >> (day.weekday() + 1) % 7 & 1
+        if self.either_day:
+            return bool(dom or dow)
+        return bool(dom and dow)
+
+    def first_time(self, hour, minute):
+        """ Returns the first (hour, minute) at or after hour:minute that
+            fires on a matching day, or None if there is none that day
+        """
+        i = bisect_left(self.hours, hour)
+        if i < len(self.hours) and self.hours[i] == hour:
+            j = bisect_left(self.minutes, minute)
+            if j < len(self.minutes):
+                return hour, self.minutes[j]
+            i += 1
+        if i < len(self.hours):
+            return self.hours[i], self.minutes[0]
+        return None
+
+    def next_after(self, after):
+        """ Returns the first minute after the datetime after that this
+            schedule fires on, in UTC. A naive after is taken to be in UTC.
+        """
+        if timezone.is_naive(after):
+            after = timezone.make_aware(after, timezone.utc)
+        else:
+            after = after.astimezone(timezone.utc)
+        start = after.replace(second=0, microsecond=0)
+        asked, answer = getattr(self._memo, "last", (None, None))
+        if asked is not None and asked <= start < answer:
+            return answer
+
+        t = start + timedelta(minutes=1)
+        day = t.date()
+        hour, minute = t.hour, t.minute
+        end = day + timedelta(days=SEARCH_DAYS)
+        while day < end:
+            if not self.months >> day.month & 1:
+                day = (day.replace(day=1) + timedelta(days=32)).replace(day=1)
+                hour = minute = 0
+                continue
+            if self.day_matches(day):
+                time = self.first_time(hour, minute)
+                if time is not None:
+                    answer = datetime(day.year, day.month, day.day,
+                                      time[0], time[1], tzinfo=timezone.utc)
+                    self._memo.last = (start, answer)
+                    return answer
+            day += timedelta(days=1)
+            hour = minute = 0
+        raise ValueError("Schedule %s never fires" % self.cron_string)
+
+
+def compiled(schedule):
+    """ Returns the CronSchedule for a Schedule, parsing it only if it has
+        not been parsed before or has changed since
+    """
+    cron_string = schedule.cron_string
+    if schedule.pk is None:
+        return CronSchedule(cron_string)
+    cron = _compiled.get(schedule.pk)
+    if cron is None or cron.cron_string != cron_string:
+        cron = _compiled[schedule.pk] = CronSchedule(cron_string)
+    return cron
+
+
+def invalidate(schedule_id):
+    _compiled.pop(schedule_id, None)
+
+
+def clear():
+    _compiled.clear()
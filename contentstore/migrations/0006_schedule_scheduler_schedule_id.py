@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contentstore', '0005_auto_20160912_0923'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='schedule',
+            name='scheduler_schedule_id',
+            field=models.CharField(blank=True, max_length=36, null=True),
+        ),
+    ]
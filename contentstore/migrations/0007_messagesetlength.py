@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.1 on 2026-10-17 17:10
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Count
+import django.db.models.deletion
+
+
+def count_messages(apps, schema_editor):
+    Message = apps.get_model('contentstore', 'Message')
+    MessageSetLength = apps.get_model('contentstore', 'MessageSetLength')
+    counts = Message.objects.order_by().values(
+        'messageset_id', 'lang').annotate(length=Count('id'))
+    MessageSetLength.objects.bulk_create([
+        MessageSetLength(messageset_id=c['messageset_id'], lang=c['lang'],
+                         length=c['length'])
+        for c in counts])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contentstore', '0006_schedule_scheduler_schedule_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageSetLength',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('lang', models.CharField(max_length=6)),
+                ('length', models.IntegerField(default=0)),
+                ('messageset', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='lengths', to='contentstore.MessageSet')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='messagesetlength',
+            unique_together=set([('messageset', 'lang')]),
+        ),
+        migrations.RunPython(count_messages, migrations.RunPython.noop),
+    ]
@@ -2,9 +2,14 @@ from datetime import datetime
 import os.path
 from rest_framework.serializers import ValidationError
 from django.db import models
+from django.db.models import F, Q
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
 from django.utils.translation import ugettext_lazy as _
 from django.utils.encoding import python_2_unicode_compatible
 
+from . import cron
+
 
 @python_2_unicode_compatible
 class Schedule(models.Model):
@@ -25,6 +30,9 @@ class Schedule(models.Model):
     month_of_year = models.CharField(
         _('month of year'), max_length=64, default='*',
     )
+    # The shared schedule on the scheduler in the "shared" dispatch mode
+    scheduler_schedule_id = models.CharField(
+        max_length=36, null=True, blank=True)
 
     class Meta:
         verbose_name = _('schedule')
@@ -43,6 +51,25 @@ class Schedule(models.Model):
     def rfield(self, s):
         return s and str(s).replace(' ', '') or '*'
 
+    def next_run(self, after):
+        """ Returns the first minute after the datetime after that this
+            schedule fires on, in UTC
+        """
+        return cron.compiled(self).next_after(after)
+
+    def clean(self):
+        # Send times are worked out from the cron fields, so they must parse
+        # and fire at some point
+        try:
+            cron.CronSchedule(self.cron_string).next_after(
+                datetime.utcnow())
+        except ValueError as e:
+            raise ValidationError(str(e))
+
+    def save(self, *args, **kwargs):
+        self.clean()
+        super(Schedule, self).save(*args, **kwargs)
+
     def __str__(self):
         return '{0} {1} {2} {3} {4} (m/h/d/dM/MY)'.format(
             self.rfield(self.minute), self.rfield(self.hour),
@@ -136,3 +163,120 @@ class Message(models.Model):
     def __str__(self):
         return _("Message %s in %s from %s") % (
             self.sequence_number, self.lang, self.messageset.short_name)
+
+
+class MessageSetLengthManager(models.Manager):
+
+    def lengths(self, keys):
+        """ Returns the number of messages for each (messageset_id, lang)
+            in keys, with one query
+        """
+        keys = set(keys)
+        lengths = dict.fromkeys(keys, 0)
+        if keys:
+            query = Q()
+            for messageset_id, lang in keys:
+                query |= Q(messageset_id=messageset_id, lang=lang)
+            for messageset_id, lang, length in self.filter(query).values_list(
+                    'messageset_id', 'lang', 'length'):
+                lengths[(messageset_id, lang)] = length
+        return lengths
+
+    def length(self, messageset_id, lang):
+        """ Returns the number of messages in a messageset for a language
+        """
+        key = (messageset_id, lang)
+        return self.lengths([key])[key]
+
+    def adjust(self, messageset_id, lang, delta):
+        """ Adds delta to the length of a messageset for a language
+        """
+        lengths = self.filter(messageset_id=messageset_id, lang=lang)
+        if not lengths.update(length=F('length') + delta) and delta > 0:
+            self.get_or_create(messageset_id=messageset_id, lang=lang)
+            lengths.update(length=F('length') + delta)
+
+
+@python_2_unicode_compatible
+class MessageSetLength(models.Model):
+
+    """
+        The number of messages in a messageset for a language, kept up to
+        date as messages are saved and deleted so that sends don't have to
+        count them
+    """
+    messageset = models.ForeignKey(MessageSet, related_name='lengths',
+                                   null=False)
+    lang = models.CharField(max_length=6, null=False, blank=False)
+    length = models.IntegerField(default=0)
+
+    objects = MessageSetLengthManager()
+
+    class Meta:
+        unique_together = ('messageset', 'lang')
+
+    def __str__(self):
+        return "%s messages in %s" % (self.length, self.lang)
+
+
+@receiver(post_save, sender=Schedule)
+@receiver(post_delete, sender=Schedule)
+def drop_compiled_schedule(sender, instance, **kwargs):
+    cron.invalidate(instance.pk)
+
+
+# Drop cached content for messages that changed. pre_save catches a message
+# moving to a different messageset, sequence number or language.
+@receiver(pre_save, sender=Message)
+def drop_previous_message_cache(sender, instance, **kwargs):
+    from .cache import invalidate_message_content
+    instance._previous = None
+    if instance.pk is not None:
+        instance._previous = Message.objects.filter(pk=instance.pk).values(
+            'messageset_id', 'sequence_number', 'lang').first()
+        if instance._previous is not None:
+            invalidate_message_content(
+                instance._previous['messageset_id'],
+                instance._previous['sequence_number'],
+                instance._previous['lang'])
+
+
+@receiver(post_save, sender=Message)
+@receiver(post_delete, sender=Message)
+def drop_message_cache(sender, instance, **kwargs):
+    from .cache import invalidate_message_content
+    invalidate_message_content(
+        instance.messageset_id, instance.sequence_number, instance.lang)
+
+
+# Keep MessageSetLength up to date, in the same transaction as the change
+@receiver(post_save, sender=Message)
+def count_saved_message(sender, instance, created, **kwargs):
+    if not created:
+        previous = getattr(instance, '_previous', None)
+        if previous is None or (previous['messageset_id'],
+                                previous['lang']) == (instance.messageset_id,
+                                                      instance.lang):
+            return
+        MessageSetLength.objects.adjust(
+            previous['messageset_id'], previous['lang'], -1)
+    MessageSetLength.objects.adjust(
+        instance.messageset_id, instance.lang, 1)
+
+
+@receiver(post_delete, sender=Message)
+def count_deleted_message(sender, instance, **kwargs):
+    MessageSetLength.objects.adjust(
+        instance.messageset_id, instance.lang, -1)
+
+
+@receiver(post_save, sender=BinaryContent)
+@receiver(post_delete, sender=BinaryContent)
+def drop_binary_message_content(sender, instance, **kwargs):
+    from .cache import invalidate_message_content
+    messages = Message.objects.filter(binary_content_id=instance.pk).values(
+        'messageset_id', 'sequence_number', 'lang')
+    for message in messages:
+        invalidate_message_content(
+            message['messageset_id'], message['sequence_number'],
+            message['lang'])
@@ -1,14 +1,21 @@
 import json
+from datetime import datetime
 
 from django.test import TestCase
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
+from django.utils import timezone
 
 from rest_framework import status
 from rest_framework.test import APIClient
 from rest_framework.authtoken.models import Token
+from rest_framework.serializers import ValidationError
 
-from .models import Schedule, MessageSet, Message
+from .models import (Schedule, MessageSet, Message, BinaryContent,
+                     MessageSetLength)
+from . import cache as content_cache
+from . import cron
 
 
 class APITestCase(TestCase):
@@ -49,6 +56,9 @@ class AuthenticatedAPITestCase(APITestCase):
         token = Token.objects.create(user=self.user)
         self.token = token.key
         self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.token)
+        cache.clear()
+        content_cache.clear_local()
+        cron.clear()
 
 
 class TestLogin(AuthenticatedAPITestCase):
@@ -167,6 +177,28 @@ class TestContentStoreApi(AuthenticatedAPITestCase):
         self.assertEqual(response.data["results"][0]["short_name"],
                          "messageset_two")
 
+    def test_list_messages_by_cursor(self):
+        # Setup
+        messageset = self.make_messageset()
+        messages = [
+            Message.objects.create(messageset=messageset, sequence_number=i,
+                                   lang='en', text_content='Foo %s' % i)
+            for i in (2, 1)]
+
+        # Execute
+        first = self.client.get(reverse('message-list'),
+                                {'cursor': '', 'limit': 1},
+                                content_type='application/json')
+        second = self.client.get(first.data['next'],
+                                 content_type='application/json')
+
+        # Check
+        # In the order created rather than by sequence_number
+        self.assertEqual(first.status_code, status.HTTP_200_OK)
+        self.assertEqual(first.data['results'][0]['id'], messages[0].id)
+        self.assertEqual(second.data['results'][0]['id'], messages[1].id)
+        self.assertEqual(second.data['next'], None)
+
     def test_create_message(self):
         """
         A POST request should create a message object for a messageset.
@@ -219,3 +251,289 @@ class TestContentStoreApi(AuthenticatedAPITestCase):
                 "unique set."]
         })
         self.assertEqual(Message.objects.all().count(), 1)
+
+
+class TestMessageContentCache(AuthenticatedAPITestCase):
+
+    def test_get_message_content(self):
+        # Setup
+        messageset = self.make_messageset()
+        message = Message.objects.create(
+            messageset=messageset, sequence_number=1, lang='en',
+            text_content="Foo")
+
+        # Execute
+        content = content_cache.get_message_content(messageset.id, 1, 'en')
+
+        # Check
+        self.assertEqual(content, {
+            "id": message.id,
+            "text_content": "Foo",
+            "binary_content_url": None,
+        })
+        with self.assertNumQueries(0):
+            content_cache.get_message_content(messageset.id, 1, 'en')
+
+    def test_get_message_content_missing(self):
+        messageset = self.make_messageset()
+        self.assertRaises(
+            Message.DoesNotExist, content_cache.get_message_content,
+            messageset.id, 1, 'en')
+
+    def test_get_message_contents(self):
+        # Setup
+        messageset = self.make_messageset()
+        binary_content = BinaryContent.objects.create(content="fakefilename")
+        Message.objects.create(
+            messageset=messageset, sequence_number=1, lang='en',
+            text_content="Foo")
+        Message.objects.create(
+            messageset=messageset, sequence_number=2, lang='en',
+            binary_content=binary_content)
+
+        # Execute
+        with self.assertNumQueries(1):
+            contents = content_cache.get_message_contents([
+                (messageset.id, 1, 'en'),
+                (messageset.id, 2, 'en'),
+                (messageset.id, 3, 'en'),
+            ])
+
+        # Check
+        self.assertEqual(sorted(contents.keys()), [
+            (messageset.id, 1, 'en'), (messageset.id, 2, 'en')])
+        self.assertEqual(contents[(messageset.id, 2, 'en')][
+            "binary_content_url"], "/media/fakefilename")
+
+    def test_message_save_invalidates_content(self):
+        # Setup
+        messageset = self.make_messageset()
+        message = Message.objects.create(
+            messageset=messageset, sequence_number=1, lang='en',
+            text_content="Foo")
+        content_cache.get_message_content(messageset.id, 1, 'en')
+
+        # Execute
+        message.text_content = "Bar"
+        message.save()
+
+        # Check
+        content = content_cache.get_message_content(messageset.id, 1, 'en')
+        self.assertEqual(content["text_content"], "Bar")
+
+    def test_message_delete_invalidates_content(self):
+        # Setup
+        messageset = self.make_messageset()
+        message = Message.objects.create(
+            messageset=messageset, sequence_number=1, lang='en',
+            text_content="Foo")
+        content_cache.get_message_content(messageset.id, 1, 'en')
+
+        # Execute
+        message.delete()
+
+        # Check
+        self.assertRaises(
+            Message.DoesNotExist, content_cache.get_message_content,
+            messageset.id, 1, 'en')
+
+
+class TestMessageSetLength(AuthenticatedAPITestCase):
+
+    def make_messages(self, messageset, count, lang='en'):
+        return [Message.objects.create(
+            messageset=messageset, sequence_number=i, lang=lang,
+            text_content="Message %s" % i) for i in range(1, count + 1)]
+
+    def test_length(self):
+        # Setup
+        messageset = self.make_messageset()
+        self.make_messages(messageset, 3)
+        self.make_messages(messageset, 2, lang='zu')
+
+        # Execute
+        with self.assertNumQueries(1):
+            length = MessageSetLength.objects.length(messageset.id, 'en')
+
+        # Check
+        self.assertEqual(length, 3)
+
+    def test_lengths(self):
+        # Setup
+        messageset = self.make_messageset()
+        self.make_messages(messageset, 3)
+        self.make_messages(messageset, 2, lang='zu')
+
+        # Execute
+        with self.assertNumQueries(1):
+            lengths = MessageSetLength.objects.lengths([
+                (messageset.id, 'en'),
+                (messageset.id, 'zu'),
+                (messageset.id, 'xh'),
+            ])
+
+        # Check
+        self.assertEqual(lengths, {
+            (messageset.id, 'en'): 3,
+            (messageset.id, 'zu'): 2,
+            (messageset.id, 'xh'): 0,
+        })
+
+    def test_message_changes_update_length(self):
+        # Setup
+        messageset = self.make_messageset()
+        messages = self.make_messages(messageset, 2)
+        self.assertEqual(
+            MessageSetLength.objects.length(messageset.id, 'en'), 2)
+
+        # Execute and check
+        Message.objects.create(
+            messageset=messageset, sequence_number=3, lang='en',
+            text_content="Message 3")
+        self.assertEqual(
+            MessageSetLength.objects.length(messageset.id, 'en'), 3)
+        messages[0].delete()
+        self.assertEqual(
+            MessageSetLength.objects.length(messageset.id, 'en'), 2)
+        messages[1].text_content = "Changed"
+        messages[1].save()
+        self.assertEqual(
+            MessageSetLength.objects.length(messageset.id, 'en'), 2)
+        messages[1].lang = 'zu'
+        messages[1].save()
+        self.assertEqual(MessageSetLength.objects.lengths([
+            (messageset.id, 'en'), (messageset.id, 'zu')]), {
+            (messageset.id, 'en'): 1, (messageset.id, 'zu'): 1})
+
+    def test_messageset_deleted_with_messages(self):
+        # Setup
+        messageset = self.make_messageset()
+        self.make_messages(messageset, 2)
+
+        # Execute
+        messageset.delete()
+
+        # Check
+        self.assertEqual(MessageSetLength.objects.count(), 0)
+
+
+def utc(*args):
+    return datetime(*args, tzinfo=timezone.utc)
+
+
+class TestScheduleNextRun(TestCase):
+
+    def test_next_run_weekly(self):
+        # Friday 10:00, fires Mondays at 08:00
+        schedule = Schedule(minute="0", hour="8", day_of_week="1")
+        self.assertEqual(
+            schedule.next_run(utc(2016, 1, 1, 10, 0)),
+            utc(2016, 1, 4, 8, 0))
+
+    def test_next_run_steps_and_lists(self):
+        schedule = Schedule(minute="*/15", hour="9-10")
+        self.assertEqual(
+            schedule.next_run(utc(2016, 1, 1, 10, 7, 30)),
+            utc(2016, 1, 1, 10, 15))
+        self.assertEqual(
+            schedule.next_run(utc(2016, 1, 1, 10, 45)),
+            utc(2016, 1, 2, 9, 0))
+
+    def test_next_run_months(self):
+        schedule = Schedule(minute="30", hour="6", day_of_month="1",
+                            month_of_year="jan,7")
+        self.assertEqual(
+            schedule.next_run(utc(2016, 2, 1)),
+            utc(2016, 7, 1, 6, 30))
+
+    def test_next_run_sunday_as_seven(self):
+        schedule = Schedule(minute="0", hour="0", day_of_week="7")
+        self.assertEqual(
+            schedule.next_run(utc(2016, 1, 1)),
+            utc(2016, 1, 3, 0, 0))
+
+    def test_next_run_day_of_month_or_week(self):
+        schedule = Schedule(minute="0", hour="0", day_of_month="15",
+                            day_of_week="mon")
+        self.assertEqual(
+            schedule.next_run(utc(2016, 1, 1)),
+            utc(2016, 1, 4, 0, 0))
+
+    def test_next_run_never(self):
+        schedule = Schedule(minute="0", hour="0", day_of_month="30",
+                            month_of_year="2")
+        self.assertRaises(ValueError, schedule.next_run, utc(2016, 1, 1))
+
+    def test_invalid_schedule_not_saved(self):
+        for fields in [{"day_of_week": "?"}, {"day_of_month": "L"},
+                       {"day_of_month": "30", "month_of_year": "2"}]:
+            schedule = Schedule(minute="0", hour="8", **fields)
+            self.assertRaises(ValidationError, schedule.save)
+        self.assertEqual(Schedule.objects.count(), 0)
+
+
+class TestCompiledSchedule(AuthenticatedAPITestCase):
+
+    def test_schedule_parsed_once(self):
+        # Setup
+        schedule = self.make_schedule()
+
+        # Execute
+        compiled = cron.compiled(schedule)
+
+        # Check
+        loaded = Schedule.objects.get(id=schedule.id)
+        self.assertIs(cron.compiled(loaded), compiled)
+
+    def test_schedule_save_drops_compiled(self):
+        # Setup
+        schedule = self.make_schedule()
+        compiled = cron.compiled(schedule)
+        self.assertEqual(schedule.next_run(utc(2016, 1, 1, 5, 0)),
+                         utc(2016, 1, 2, 1, 0))
+
+        # Execute
+        schedule.hour = "6"
+        schedule.minute = "0"
+        schedule.save()
+
+        # Check
+        self.assertIsNot(cron.compiled(schedule), compiled)
+        self.assertEqual(schedule.next_run(utc(2016, 1, 1, 5, 0)),
+                         utc(2016, 1, 1, 6, 0))
+
+    def test_stale_compiled_schedule_rebuilt(self):
+        # Setup
+        schedule = self.make_schedule()
+        cron.compiled(schedule)
+
+        # Execute
+        Schedule.objects.filter(id=schedule.id).update(hour="7")
+        schedule = Schedule.objects.get(id=schedule.id)
+
+        # Check
+        self.assertEqual(schedule.next_run(utc(2016, 1, 1, 5, 0)),
+                         utc(2016, 1, 1, 7, 0))
+
+    def test_next_after_reuses_last_answer(self):
+        # Setup
+        compiled = cron.CronSchedule("0 8 1 * *")
+        first = compiled.next_after(utc(2016, 1, 1, 10, 0))
+
+        # Execute
+        compiled.first_time = None
+        later = compiled.next_after(utc(2016, 1, 3, 23, 59))
+
+        # Check
+        self.assertEqual(first, utc(2016, 1, 4, 8, 0))
+        self.assertEqual(later, first)
+
+    def test_next_after_naive_and_aware(self):
+        compiled = cron.CronSchedule("0 8 * * *")
+        self.assertEqual(compiled.next_after(datetime(2016, 1, 1, 10, 0)),
+                         utc(2016, 1, 2, 8, 0))
+        # 10:00 in UTC+2
+        self.assertEqual(
+            compiled.next_after(utc(2016, 1, 1, 10, 0).astimezone(
+                timezone.get_fixed_timezone(120))),
+            utc(2016, 1, 2, 8, 0))
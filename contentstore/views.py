@@ -1,6 +1,8 @@
 from .models import Schedule, MessageSet, Message, BinaryContent
 from rest_framework.viewsets import ModelViewSet
 from rest_framework.permissions import IsAuthenticated
+from seed_stage_based_messaging.pagination import (
+    LimitOffsetOrKeysetPagination)
 from .serializers import (ScheduleSerializer, MessageSetSerializer,
                           MessageSerializer, BinaryContentSerializer,
                           MessageListSerializer, MessageSetMessagesSerializer)
@@ -24,6 +26,7 @@ class MessageSetViewSet(ModelViewSet):
     permission_classes = (IsAuthenticated,)
     queryset = MessageSet.objects.all()
     serializer_class = MessageSetSerializer
+    pagination_class = LimitOffsetOrKeysetPagination
     filter_fields = ('short_name', 'content_type', )
 
 
@@ -35,6 +38,7 @@ class MessageViewSet(ModelViewSet):
     permission_classes = (IsAuthenticated,)
     queryset = Message.objects.all()
     serializer_class = MessageSerializer
+    pagination_class = LimitOffsetOrKeysetPagination
     filter_fields = ('messageset', 'sequence_number', 'lang', )
 
 
@@ -6,6 +6,8 @@ Client for Messaging Content Store HTTP services APIs.
 import requests
 import json
 
+from seed_stage_based_messaging.utils import map_concurrently
+
 
 class SchedulerApiClient(object):
 
@@ -68,3 +70,22 @@ class SchedulerApiClient(object):
     def delete_schedule(self, schedule_id):
         # Schedule messages must all be deleted first for FK reasons
         return self.call('schedule', 'delete', obj=schedule_id)
+
+    def create_schedules(self, schedules, concurrency=10):
+        """
+        Creates each of schedules, with up to concurrency calls in flight.
+        Returns the results in order, with the exception raised in place of
+        the result of any call that failed.
+        """
+        return map_concurrently(self.create_schedule, schedules, concurrency)
+
+    def update_schedules(self, updates, concurrency=10):
+        """ updates is a list of (schedule_id, schedule) """
+        return map_concurrently(
+            lambda update: self.update_schedule(*update), updates,
+            concurrency)
+
+    def disable_schedules(self, schedule_ids, concurrency=10):
+        return self.update_schedules(
+            [(schedule_id, {"enabled": False})
+             for schedule_id in schedule_ids], concurrency)
@@ -0,0 +1,112 @@
+"""
+Pagination for the list APIs.
+
+Lists are paged with limit and offset by default. Passing a cursor parameter
+(empty for the first page) pages by keyset instead: rows are ordered by
+(created_at, id) and each page continues after the last row of the page
+before, so a page deep into the list costs the same as the first one.
+"""
+import base64
+import binascii
+from collections import OrderedDict
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import LimitOffsetPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+KEYSET_ORDERING = ("created_at", "pk")
+
+
+def encode_cursor(created_at, pk):
+    """ Returns an opaque cursor for the position after (created_at, pk)
+    """
+    position = "%s|%s" % (created_at.isoformat(), pk)
+    return base64.urlsafe_b64encode(position.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor, model):
+    """ Returns the (created_at, pk) position in a cursor for a list of
+        model, raising ValueError if it is not a valid cursor
+    """
+    try:
+        position = base64.urlsafe_b64decode(
+            cursor.encode("ascii")).decode("utf-8")
+        created_at, pk = position.split("|", 1)
+        pk = model._meta.pk.to_python(pk)
+    except (TypeError, ValueError, UnicodeError, binascii.Error,
+            ValidationError):
+        raise ValueError("Invalid cursor")
+    created_at = parse_datetime(created_at)
+    if created_at is None:
+        raise ValueError("Invalid cursor")
+    return created_at, pk
+
+
+def keyset_after(queryset, created_at, pk):
+    """ Filters queryset, ordered by KEYSET_ORDERING, to the rows after
+        (created_at, pk). The created_at bound on its own lets an index on
+        (created_at, id) be range scanned from the position.
+    """
+    return queryset.filter(
+        Q(created_at__gt=created_at) | Q(pk__gt=pk),
+        created_at__gte=created_at)
+
+
+class LimitOffsetOrKeysetPagination(LimitOffsetPagination):
+
+    """ Limit and offset pagination, or keyset pagination on
+        (created_at, id) when the cursor parameter is given. Keyset pages
+        have the same limit and only link to the next page.
+    """
+    cursor_query_param = "cursor"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.keyset = self.cursor_query_param in request.query_params
+        if not self.keyset:
+            return super(LimitOffsetOrKeysetPagination,
+                         self).paginate_queryset(queryset, request, view)
+
+        self.limit = self.get_limit(request)
+        self.request = request
+        queryset = queryset.order_by(*KEYSET_ORDERING)
+        cursor = request.query_params[self.cursor_query_param]
+        if cursor:
+            try:
+                queryset = keyset_after(
+                    queryset, *decode_cursor(cursor, queryset.model))
+            except ValueError as e:
+                raise NotFound(str(e))
+
+        rows = list(queryset[:self.limit + 1])
+        self.next_cursor = None
+        if len(rows) > self.limit:
+            rows = rows[:self.limit]
+            last = rows[-1]
+            if isinstance(last, dict):
+                # From values()
+                self.next_cursor = encode_cursor(
+                    last["created_at"], last["id"])
+            else:
+                self.next_cursor = encode_cursor(last.created_at, last.pk)
+        return rows
+
+    def get_next_link(self):
+        if not self.keyset:
+            return super(LimitOffsetOrKeysetPagination, self).get_next_link()
+        if self.next_cursor is None:
+            return None
+        return replace_query_param(self.request.build_absolute_uri(),
+                                   self.cursor_query_param, self.next_cursor)
+
+    def get_paginated_response(self, data):
+        if not self.keyset:
+            return super(LimitOffsetOrKeysetPagination,
+                         self).get_paginated_response(data)
+        return Response(OrderedDict([
+            ("next", self.get_next_link()),
+            ("results", data),
+        ]))
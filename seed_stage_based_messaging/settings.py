@@ -89,6 +89,22 @@ DATABASES = {
 }
 
 
+# Cache
+# The identity and message content caches are read by the web processes and
+# every worker, so the cache must be shared between them. The default database
+# cache needs ./manage.py createcachetable; set CACHE_BACKEND and
+# CACHE_LOCATION to use memcached instead.
+
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get(
+            'CACHE_BACKEND', 'django.core.cache.backends.db.DatabaseCache'),
+        'LOCATION': os.environ.get(
+            'CACHE_LOCATION', 'seed_stage_based_messaging_cache'),
+    }
+}
+
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.9/topics/i18n/
 
@@ -174,6 +190,12 @@ CELERY_ROUTES = {
     'subscriptions.tasks.post_send_process': {
         'queue': 'priority',
     },
+    'subscriptions.tasks.send_schedule': {
+        'queue': 'priority',
+    },
+    'subscriptions.tasks.send_next_message_batch': {
+        'queue': 'priority',
+    },
     'subscriptions.tasks.schedule_create': {
         'queue': 'priority',
     },
@@ -211,12 +233,12 @@ METRICS_SCHEDULED = [
     'subscriptions.broken.last',
     'subscriptions.completed.last'
 ]
+# fire_subscription_metrics fires all of METRICS_SCHEDULED and the
+# messageset active counts from one query. The per metric tasks
+# fire_active_last, fire_created_last, fire_broken_last, fire_completed_last
+# and fire_messagesets_tasks can still be listed instead.
 METRICS_SCHEDULED_TASKS = [
-    'fire_active_last',
-    'fire_created_last',
-    'fire_broken_last',
-    'fire_completed_last',
-    'fire_messagesets_tasks'
+    'fire_subscription_metrics',
 ]
 
 CELERY_TASK_SERIALIZER = 'json'
@@ -228,16 +250,73 @@ djcelery.setup_loader()
 
 STAGE_BASED_MESSAGING_URL = os.environ.get("STAGE_BASED_MESSAGING_URL", None)
 
+# How sends are triggered:
+#   "subscription" - one scheduler schedule per subscription, each calling
+#                    back to /api/v1/subscriptions/<id>/send
+#   "schedule" - one celerybeat periodic task per contentstore Schedule,
+#                sending to all its due subscriptions in batches
+#   "queue" - the same periodic tasks mark subscriptions as due and
+#             process_send_queue workers claim and send them from the
+#             database with SELECT ... FOR UPDATE SKIP LOCKED
+#   "shared" - one scheduler schedule per contentstore Schedule, calling back
+#              to /api/v1/subscriptions/schedule/<id>/send, which sends to
+#              all its due subscriptions in batches
+SUBSCRIPTION_DISPATCH_MODE = os.environ.get(
+    "SUBSCRIPTION_DISPATCH_MODE", "subscription")
+SUBSCRIPTION_BATCH_SIZE = int(os.environ.get("SUBSCRIPTION_BATCH_SIZE", 500))
+# Keep running subscription counts per messageset for the metrics, instead
+# of counting the subscriptions table. Schedule the
+# reconcile_subscription_counters task to correct any drift.
+SUBSCRIPTION_COUNTERS = os.environ.get(
+    "SUBSCRIPTION_COUNTERS", "false").lower() == "true"
+# Advance or complete subscriptions as part of send_next_message instead of
+# in a separate post_send_process task
+SUBSCRIPTION_FUSED_POST_SEND = os.environ.get(
+    "SUBSCRIPTION_FUSED_POST_SEND", "false").lower() == "true"
+
 SCHEDULER_URL = os.environ.get("SCHEDULER_URL", None)
 SCHEDULER_API_TOKEN = os.environ.get("SCHEDULER_API_TOKEN", "REPLACEME")
 SCHEDULER_INBOUND_API_TOKEN = \
     os.environ.get("SCHEDULER_INBOUND_API_TOKEN", "REPLACEMEONLOAD")
+# Concurrent scheduler calls when creating or disabling schedules in bulk
+SCHEDULER_CONCURRENCY = int(os.environ.get("SCHEDULER_CONCURRENCY", 10))
 
 IDENTITY_STORE_URL = os.environ.get("IDENTITY_STORE_URL", None)
 IDENTITY_STORE_TOKEN = os.environ.get("IDENTITY_STORE_TOKEN", "REPLACEME")
+# Seconds to cache identities and their addresses for, and to remember
+# identities that have no address. Changes reach the cache through the
+# invalidate endpoint, or once the entry expires.
+IDENTITY_CACHE_TTL = int(os.environ.get("IDENTITY_CACHE_TTL", 60 * 15))
+IDENTITY_CACHE_NEGATIVE_TTL = int(
+    os.environ.get("IDENTITY_CACHE_NEGATIVE_TTL", 60 * 5))
+# Concurrent identity store lookups when resolving a batch of subscriptions
+IDENTITY_STORE_CONCURRENCY = int(
+    os.environ.get("IDENTITY_STORE_CONCURRENCY", 10))
+
+# Seconds to cache message content for in each process, and in the shared
+# cache. Content changes reach other processes after the local TTL.
+MESSAGE_CONTENT_LOCAL_TTL = int(
+    os.environ.get("MESSAGE_CONTENT_LOCAL_TTL", 60))
+MESSAGE_CONTENT_CACHE_TTL = int(
+    os.environ.get("MESSAGE_CONTENT_CACHE_TTL", 60 * 60 * 24))
 
 MESSAGE_SENDER_URL = os.environ.get("MESSAGE_SENDER_URL", None)
 MESSAGE_SENDER_TOKEN = os.environ.get("MESSAGE_SENDER_TOKEN", "REPLACEME")
+# Concurrent message sender submissions when sending a batch of subscriptions
+MESSAGE_SENDER_CONCURRENCY = int(
+    os.environ.get("MESSAGE_SENDER_CONCURRENCY", 10))
 
 METRICS_URL = os.environ.get("METRICS_URL", None)
 METRICS_AUTH_TOKEN = os.environ.get("METRICS_AUTH_TOKEN", "REPLACEME")
+# Seconds to add up sum metrics in each process for before firing them
+# together, 0 fires a task for every increment
+METRICS_BUFFER_INTERVAL = int(os.environ.get("METRICS_BUFFER_INTERVAL", 0))
+
+# Shared HTTP sessions for the identity store, message sender, scheduler and
+# metrics APIs. Only idempotent requests are retried on 502, 503 and 504.
+# HTTP_POOL_SIZE should be at least the largest *_CONCURRENCY setting.
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", 10))
+HTTP_MAX_RETRIES = int(os.environ.get("HTTP_MAX_RETRIES", 3))
+HTTP_RETRY_BACKOFF = float(os.environ.get("HTTP_RETRY_BACKOFF", 0.5))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", 5))
+HTTP_READ_TIMEOUT = float(os.environ.get("HTTP_READ_TIMEOUT", 30))
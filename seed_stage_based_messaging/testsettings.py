@@ -25,4 +25,10 @@ MESSAGE_SENDER_TOKEN = "REPLACEME"
 METRICS_URL = "http://metrics-url"
 METRICS_AUTH_TOKEN = "REPLACEME"
 
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
 PASSWORD_HASHERS = ('django.contrib.auth.hashers.MD5PasswordHasher',)
@@ -1,34 +1,245 @@
+import os
+import threading
 import requests
+from itertools import islice
+from multiprocessing.pool import ThreadPool
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
 from django.conf import settings
+from django.core.cache import cache
 from contentstore.models import MessageSet
 
 
+class PooledSession(requests.Session):
+
+    """ A requests session that applies a default timeout to every request
+    """
+
+    def __init__(self, timeout=None):
+        super(PooledSession, self).__init__()
+        self.timeout = timeout
+
+    def request(self, *args, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return super(PooledSession, self).request(*args, **kwargs)
+
+
+_sessions = {}
+
+
+def get_session(service, headers=None):
+    """ Returns the shared session for talking to service. Sessions are kept
+        per process so that forked workers don't share sockets, and keep
+        their connections alive between calls. headers are only applied when
+        the session is first created.
+    """
+    key = (os.getpid(), service)
+    session = _sessions.get(key)
+    if session is None:
+        session = PooledSession(timeout=(settings.HTTP_CONNECT_TIMEOUT,
+                                         settings.HTTP_READ_TIMEOUT))
+        retries = Retry(
+            total=settings.HTTP_MAX_RETRIES,
+            backoff_factor=settings.HTTP_RETRY_BACKOFF,
+            status_forcelist=(502, 503, 504))
+        adapter = HTTPAdapter(pool_connections=settings.HTTP_POOL_SIZE,
+                              pool_maxsize=settings.HTTP_POOL_SIZE,
+                              max_retries=retries)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        if headers is not None:
+            session.headers.update(headers)
+        _sessions[key] = session
+    return session
+
+
+def identity_store_session():
+    return get_session("identity_store", headers={
+        'Authorization': 'Token %s' % settings.IDENTITY_STORE_TOKEN,
+        'Content-Type': 'application/json'
+    })
+
+
+def message_sender_session():
+    return get_session("message_sender", headers={
+        'Authorization': 'Token %s' % settings.MESSAGE_SENDER_TOKEN,
+        'Content-Type': 'application/json'
+    })
+
+
+# Cached value for identities without an address, as the cache can't tell a
+# stored None apart from a miss
+NO_ADDRESS = "__no_address__"
+
+
+def identity_cache_key(identity_uuid):
+    return "identity:%s" % identity_uuid
+
+
+def identity_address_cache_key(identity_uuid):
+    return "identity_address:%s" % identity_uuid
+
+
 def get_identity(identity_uuid):
+    key = identity_cache_key(identity_uuid)
+    identity = cache.get(key)
+    if identity is not None:
+        return identity
+
     url = "%s/%s/%s/" % (settings.IDENTITY_STORE_URL, "identities",
                          identity_uuid)
-    headers = {
-        'Authorization': 'Token %s' % settings.IDENTITY_STORE_TOKEN,
-        'Content-Type': 'application/json'
-    }
-    r = requests.get(url, headers=headers)
-    return r.json()
+    r = identity_store_session().get(url)
+    identity = r.json()
+    if r.ok:
+        cache.set(key, identity, settings.IDENTITY_CACHE_TTL)
+    return identity
 
 
 def get_identity_address(identity_uuid):
+    key = identity_address_cache_key(identity_uuid)
+    address = cache.get(key)
+    if address is not None:
+        return None if address == NO_ADDRESS else address
+
     url = "%s/%s/%s/addresses/msisdn" % (settings.IDENTITY_STORE_URL,
                                          "identities", identity_uuid)
     params = {"default": True}
-    headers = {
-        'Authorization': 'Token %s' % settings.IDENTITY_STORE_TOKEN,
-        'Content-Type': 'application/json'
-    }
-    r = requests.get(url, params=params, headers=headers).json()
+    r = identity_store_session().get(url, params=params).json()
     if len(r["results"]) > 0:
-        return r["results"][0]["address"]
+        address = r["results"][0]["address"]
+        cache.set(key, address, settings.IDENTITY_CACHE_TTL)
+        return address
     else:
+        cache.set(key, NO_ADDRESS, settings.IDENTITY_CACHE_NEGATIVE_TTL)
         return None
 
 
+def invalidate_identity(identity_uuid):
+    """ Removes an identity and its address from the cache, so that the next
+        lookup goes to the identity store
+    """
+    cache.delete_many([identity_cache_key(identity_uuid),
+                       identity_address_cache_key(identity_uuid)])
+
+
+class LookupCoalescer(object):
+
+    """ Runs a lookup once for all the threads in this process that ask for
+        the same key at the same time, handing each of them the result
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.inflight = {}
+
+    def call(self, key, func, *args):
+        with self.lock:
+            lookup = self.inflight.get(key)
+            leader = lookup is None
+            if leader:
+                lookup = self.inflight[key] = {
+                    "done": threading.Event(), "result": None, "error": None}
+
+        if leader:
+            try:
+                lookup["result"] = func(*args)
+            except Exception as e:
+                lookup["error"] = e
+            finally:
+                with self.lock:
+                    del self.inflight[key]
+                lookup["done"].set()
+        else:
+            lookup["done"].wait()
+
+        if lookup["error"] is not None:
+            raise lookup["error"]
+        return lookup["result"]
+
+
+identity_lookups = LookupCoalescer()
+
+
+def map_concurrently(func, items, concurrency):
+    """ Calls func on each of items using up to concurrency threads and
+        returns the results in the same order. An exception raised by func is
+        returned in place of its result, so one failure doesn't lose the
+        others.
+    """
+    def call(item):
+        try:
+            return func(item)
+        except Exception as e:
+            return e
+
+    if not items:
+        return []
+    pool = ThreadPool(max(1, min(concurrency, len(items))))
+    try:
+        return pool.map(call, items)
+    finally:
+        pool.close()
+
+
+def _lookup_many(func, key_func, identity_uuids, concurrency):
+    """ Looks up each identity with func, at most concurrency at a time.
+        Identities whose lookup fails are left out of the returned dict.
+    """
+    results = map_concurrently(
+        lambda identity_uuid: identity_lookups.call(
+            key_func(identity_uuid), func, identity_uuid),
+        identity_uuids, concurrency)
+    return dict((identity_uuid, result)
+                for identity_uuid, result in zip(identity_uuids, results)
+                if not isinstance(result, Exception))
+
+
+def get_identity_addresses(identity_uuids, concurrency=None):
+    """ Resolves the addresses to send to for many identities at once,
+        following communicate_through, with each distinct identity and
+        address looked up at most once and at most concurrency lookups
+        (default settings.IDENTITY_STORE_CONCURRENCY) at a time. Returns a
+        dict of identity to address, or None if it has no address. Identities
+        that could not be looked up are left out.
+    """
+    if concurrency is None:
+        concurrency = settings.IDENTITY_STORE_CONCURRENCY
+    identity_uuids = list(set(identity_uuids))
+
+    # First pass: identities, to find who to communicate through
+    identities = cache.get_many(
+        [identity_cache_key(i) for i in identity_uuids])
+    identities = dict((i, identities[identity_cache_key(i)])
+                      for i in identity_uuids
+                      if identity_cache_key(i) in identities)
+    identities.update(_lookup_many(
+        get_identity, identity_cache_key,
+        [i for i in identity_uuids if i not in identities], concurrency))
+
+    targets = {}
+    for identity_uuid, identity in identities.items():
+        targets[identity_uuid] = \
+            identity.get("communicate_through") or identity_uuid
+
+    # Second pass: the addresses of everyone we're sending to
+    target_uuids = list(set(targets.values()))
+    cached = cache.get_many(
+        [identity_address_cache_key(i) for i in target_uuids])
+    addresses = {}
+    for target_uuid in target_uuids:
+        address = cached.get(identity_address_cache_key(target_uuid))
+        if address is not None:
+            addresses[target_uuid] = None if address == NO_ADDRESS else address
+    addresses.update(_lookup_many(
+        get_identity_address, identity_address_cache_key,
+        [i for i in target_uuids if i not in addresses], concurrency))
+
+    return dict((identity_uuid, addresses[target_uuid])
+                for identity_uuid, target_uuid in targets.items()
+                if target_uuid in addresses)
+
+
 def get_available_metrics():
     available_metrics = []
     available_metrics.extend(settings.METRICS_REALTIME)
@@ -40,3 +251,29 @@ def get_available_metrics():
             "subscriptions.%s.active.last" % messageset.short_name)
 
     return available_metrics
+
+
+def chunks(iterable, size):
+    """ Yields lists of at most `size` items from `iterable`, without
+        loading the whole iterable into memory.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def id_chunks(queryset, size):
+    """ Yields lists of at most `size` ids from `queryset`, in id order. Each
+        chunk is a separate query continuing after the last id of the one
+        before, so only one chunk is held in memory at a time.
+    """
+    queryset = queryset.order_by('pk').values_list('pk', flat=True)
+    chunk = list(queryset[:size])
+    while chunk:
+        yield chunk
+        if len(chunk) < size:
+            return
+        chunk = list(queryset.filter(pk__gt=chunk[-1])[:size])
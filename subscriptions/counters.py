@@ -0,0 +1,143 @@
+"""
+Running subscription counts per messageset, for metrics that would
+otherwise count the whole subscriptions table.
+
+When SUBSCRIPTION_COUNTERS is on, every change to a subscription that moves
+it in or out of a bucket adjusts the SubscriptionCounter rows for its
+messageset. Saves go through the post_save handling, and the bulk paths
+that use update() or bulk_create() record their changes themselves.
+reconcile() recounts everything from the subscriptions table, to fix any
+drift from changes made some other way.
+"""
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, Count, F, IntegerField, Sum, When
+
+from .models import Subscription, SubscriptionCounter
+
+# The conditions for a subscription to be counted in each bucket
+BUCKET_FILTERS = {
+    "created": {},
+    "active": {"active": True},
+    "completed": {"completed": True},
+    "broken": {"process_status": -1},
+}
+
+
+def count_if(**conditions):
+    return Sum(Case(When(then=1, **conditions), default=0,
+                    output_field=IntegerField()))
+
+
+def bucket_aggregates(prefix=""):
+    """ Returns aggregates counting each bucket, for annotate(), prefix
+        being the lookup path to the subscriptions
+    """
+    aggregates = {}
+    for bucket, conditions in BUCKET_FILTERS.items():
+        if conditions:
+            aggregates[bucket] = count_if(**dict(
+                (prefix + field, value)
+                for field, value in conditions.items()))
+        else:
+            aggregates[bucket] = Count(prefix.rstrip("_") or "id")
+    return aggregates
+
+
+def buckets(state):
+    """ Returns the buckets a subscription with the tracked_state state is
+        counted in
+    """
+    return [bucket for bucket, conditions in BUCKET_FILTERS.items()
+            if all(state[field] == value
+                   for field, value in conditions.items())]
+
+
+def record_change(previous, current):
+    """ Adjusts the counters for a subscription changing from the
+        tracked_state previous to current. previous is None for new
+        subscriptions, and current None for deleted ones.
+    """
+    record_changes([(previous, current)])
+
+
+def record_changes(changes):
+    """ Adjusts the counters for many (previous, current) changes at once
+    """
+    deltas = {}
+    for previous, current in changes:
+        if previous is not None:
+            for bucket in buckets(previous):
+                key = (previous["messageset_id"], bucket)
+                deltas[key] = deltas.get(key, 0) - 1
+        if current is not None:
+            for bucket in buckets(current):
+                key = (current["messageset_id"], bucket)
+                deltas[key] = deltas.get(key, 0) + 1
+    apply_deltas(deltas)
+
+
+def apply_deltas(deltas):
+    """ Adds each delta to the counter for its (messageset_id, bucket)
+    """
+    if not settings.SUBSCRIPTION_COUNTERS:
+        return
+    for (messageset_id, bucket), delta in deltas.items():
+        if delta == 0:
+            continue
+        counters = SubscriptionCounter.objects.filter(
+            messageset_id=messageset_id, bucket=bucket)
+        if not counters.update(count=F('count') + delta):
+            SubscriptionCounter.objects.get_or_create(
+                messageset_id=messageset_id, bucket=bucket)
+            counters.update(count=F('count') + delta)
+
+
+def count(bucket, messageset_id=None):
+    """ Returns the number of subscriptions in bucket, on messageset_id or
+        on all messagesets, from the counters if SUBSCRIPTION_COUNTERS is on
+        and otherwise by counting them
+    """
+    if settings.SUBSCRIPTION_COUNTERS:
+        return get_count(bucket, messageset_id)
+    subscriptions = Subscription.objects.filter(**BUCKET_FILTERS[bucket])
+    if messageset_id is not None:
+        subscriptions = subscriptions.filter(messageset_id=messageset_id)
+    return subscriptions.count()
+
+
+def get_count(bucket, messageset_id=None):
+    """ Returns the number of subscriptions in bucket, on messageset_id or
+        on all messagesets
+    """
+    counters = SubscriptionCounter.objects.filter(bucket=bucket)
+    if messageset_id is not None:
+        counters = counters.filter(messageset_id=messageset_id)
+    return counters.aggregate(total=Sum('count'))['total'] or 0
+
+
+def reconcile():
+    """ Recounts every counter from the subscriptions table with one
+        grouped query, returning the number of counters corrected
+    """
+    counts = Subscription.objects.order_by().values(
+        'messageset_id').annotate(**bucket_aggregates())
+    actual = {}
+    for row in counts:
+        for bucket in BUCKET_FILTERS:
+            actual[(row['messageset_id'], bucket)] = row[bucket]
+
+    corrected = 0
+    with transaction.atomic():
+        for counter in SubscriptionCounter.objects.select_for_update():
+            key = (counter.messageset_id, counter.bucket)
+            count = actual.pop(key, 0)
+            if counter.count != count:
+                counter.count = count
+                counter.save(update_fields=['count'])
+                corrected += 1
+        for (messageset_id, bucket), count in actual.items():
+            SubscriptionCounter.objects.create(
+                messageset_id=messageset_id, bucket=bucket, count=count)
+            corrected += 1
+    return corrected
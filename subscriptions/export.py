@@ -0,0 +1,79 @@
+"""
+Streaming export of subscriptions as JSON lines or CSV.
+
+Subscriptions are read a chunk at a time in (created_at, id) order, each
+chunk continuing after the last row of the one before, and written out as
+they are read, so an export takes the same memory however many rows it has.
+Rows are read with values() and turned into dicts by
+SubscriptionRowSerializer rather than going through SubscriptionSerializer.
+"""
+import csv
+import json
+
+from django.conf import settings
+from django.utils import six
+
+from seed_stage_based_messaging.pagination import (
+    KEYSET_ORDERING, keyset_after)
+from .serializers import SubscriptionRowSerializer
+
+
+def iter_rows(queryset, chunk_size=None):
+    """ Yields the serialized subscriptions in queryset, reading chunk_size
+        (default settings.SUBSCRIPTION_BATCH_SIZE) at a time
+    """
+    if chunk_size is None:
+        chunk_size = settings.SUBSCRIPTION_BATCH_SIZE
+    serializer = SubscriptionRowSerializer()
+    queryset = queryset.order_by(*KEYSET_ORDERING).values(
+        *serializer.value_fields)
+    chunk = list(queryset[:chunk_size])
+    while chunk:
+        for row in chunk:
+            yield serializer.to_representation(row)
+        if len(chunk) < chunk_size:
+            return
+        last = chunk[-1]
+        chunk = list(keyset_after(
+            queryset, last['created_at'], last['id'])[:chunk_size])
+
+
+def write_jsonl(rows):
+    for row in rows:
+        yield json.dumps(row) + "\n"
+
+
+class Echo(object):
+
+    """ A file-like object for csv.writer that returns what is written
+        instead of keeping it
+    """
+
+    def write(self, value):
+        return value
+
+
+def csv_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, (dict, list)):
+        value = json.dumps(value)
+    value = six.text_type(value)
+    if six.PY2:
+        value = value.encode("utf-8")
+    return value
+
+
+def write_csv(rows):
+    writer = csv.writer(Echo())
+    fields = SubscriptionRowSerializer.fields
+    yield writer.writerow(fields)
+    for row in rows:
+        yield writer.writerow([csv_value(row[field]) for field in fields])
+
+
+# The content type and writer for each export format
+WRITERS = {
+    "jsonl": ("application/x-ndjson", write_jsonl),
+    "csv": ("text/csv", write_csv),
+}
@@ -0,0 +1,120 @@
+"""
+Bulk creation of subscriptions from JSON lines or CSV.
+
+Rows are validated and inserted a chunk at a time with bulk_create, so the
+post_save handling does not run. Instead each chunk queues one
+schedule_create_batch task for its new subscriptions and fires one
+subscriptions.created.sum increment for the lot.
+"""
+import csv
+import json
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import six, timezone
+
+from seed_stage_based_messaging import utils
+from . import counters, metrics
+from .models import Subscription, next_send_time
+from .serializers import SubscriptionImportSerializer
+
+
+class InvalidImport(Exception):
+
+    """ The import data could not be read """
+
+
+def read_jsonl(lines):
+    """ Yields a row for each non-blank line of JSON lines, given as bytes
+    """
+    for line in lines:
+        line = line.strip()
+        if line:
+            try:
+                yield json.loads(line.decode("utf-8"))
+            except ValueError as e:
+                raise InvalidImport("Invalid JSON line: %s" % e)
+
+
+def read_csv(lines):
+    """ Yields a row for each line of CSV with a header row, given as bytes.
+        Blank values are left out so that field defaults apply, and the
+        metadata column is parsed as JSON.
+    """
+    if six.PY2:
+        reader = csv.DictReader(lines)
+    else:
+        reader = csv.DictReader(line.decode("utf-8") for line in lines)
+    for row in reader:
+        if six.PY2:
+            row = dict((key.decode("utf-8"), value.decode("utf-8"))
+                       for key, value in row.items()
+                       if key is not None and value is not None)
+        row = dict((key, value) for key, value in row.items()
+                   if key is not None and value)
+        if "metadata" in row:
+            try:
+                row["metadata"] = json.loads(row["metadata"])
+            except ValueError as e:
+                raise InvalidImport("Invalid metadata JSON: %s" % e)
+        yield row
+
+
+READERS = {
+    "jsonl": read_jsonl,
+    "csv": read_csv,
+}
+
+
+def create_subscriptions(subscriptions):
+    """ Inserts unsaved subscriptions with one query and does what the
+        post_save receivers would have done for them, once for the lot
+    """
+    from .tasks import schedule_create_batch
+
+    now = timezone.now()
+    for subscription in subscriptions:
+        if subscription.active and not subscription.completed:
+            subscription.next_send_at = next_send_time(
+                subscription.schedule, now)
+    with transaction.atomic():
+        Subscription.objects.bulk_create(subscriptions)
+        counters.record_changes(
+            (None, s.tracked_state()) for s in subscriptions)
+
+    if settings.SUBSCRIPTION_DISPATCH_MODE == "subscription":
+        to_schedule = [str(s.id) for s in subscriptions
+                       if s.active and not s.completed and
+                       s.process_status == 0]
+        if to_schedule:
+            schedule_create_batch.apply_async(args=[to_schedule])
+    metrics.increment('subscriptions.created.sum', len(subscriptions))
+
+
+def import_subscriptions(rows, chunk_size=None):
+    """ Validates and creates a subscription for each row, chunk_size
+        (default settings.SUBSCRIPTION_BATCH_SIZE) at a time. Returns the
+        number created and a list of the invalid rows, numbered from 1, with
+        their errors.
+    """
+    if chunk_size is None:
+        chunk_size = settings.SUBSCRIPTION_BATCH_SIZE
+    context = {}
+    created = 0
+    errors = []
+    rows = enumerate(rows, 1)
+    for chunk in utils.chunks(rows, chunk_size):
+        subscriptions = []
+        for number, row in chunk:
+            if isinstance(row, dict) and "metadata" not in row:
+                row["metadata"] = {}
+            serializer = SubscriptionImportSerializer(
+                data=row, context=context)
+            if serializer.is_valid():
+                subscriptions.append(Subscription(**serializer.validated_data))
+            else:
+                errors.append({"row": number, "errors": serializer.errors})
+        if subscriptions:
+            create_subscriptions(subscriptions)
+            created += len(subscriptions)
+    return created, errors
@@ -0,0 +1,122 @@
+import json
+import re
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from subscriptions.models import Subscription
+
+TABLE = "benchmark_subscriptions"
+
+# 1 in 10 subscriptions completed, 1 in 1000 broken, 20 messagesets and
+# 100 schedules, and two subscriptions per identity
+FILL_SQL = """
+INSERT INTO {table} (
+    id, identity, version, messageset_id, next_sequence_number, lang,
+    active, completed, schedule_id, process_status, metadata, created_at,
+    updated_at)
+SELECT
+    md5(i::text)::uuid, md5((i / 2)::text)::uuid::text, 1, i % 20 + 1,
+    1, 'en_ZA', i % 10 <> 0, i % 10 = 0, i % 100 + 1,
+    CASE WHEN i % 10 = 0 THEN 2 WHEN i % 1000 = 1 THEN -1 ELSE 0 END,
+    '{{}}', now() - i * interval '1 second', now()
+FROM generate_series(1, {rows:d}) AS i
+"""
+
+QUERIES = [
+    ("identity filter",
+     "SELECT id FROM {table} WHERE identity = md5('1234')::uuid::text"),
+    ("messageset active count",
+     "SELECT count(*) FROM {table} WHERE messageset_id = 1 AND active"),
+    ("broken count",
+     "SELECT count(*) FROM {table} WHERE process_status = -1"),
+    ("idle on schedule",
+     "SELECT id FROM {table} WHERE schedule_id = 1 AND active "
+     "AND NOT completed AND process_status = 0"),
+]
+
+
+def scan_nodes(plan):
+    """ Yields the scan node types in a plan tree
+    """
+    if "Scan" in plan["Node Type"]:
+        yield plan["Node Type"]
+    for child in plan.get("Plans", []):
+        for node in scan_nodes(child):
+            yield node
+
+
+class Command(BaseCommand):
+    help = ("Fills a temporary table shaped like the subscriptions table and "
+            "compares the query plans and times of the list filters and "
+            "metric counts with and without the subscriptions indexes.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--rows", type=int, default=5000000,
+            help="Number of subscriptions to generate")
+
+    def explain(self, cursor, sql):
+        cursor.execute("EXPLAIN (ANALYZE, FORMAT JSON) " + sql)
+        result = cursor.fetchone()[0]
+        if not isinstance(result, list):
+            result = json.loads(result)
+        plan = result[0]
+        return ", ".join(scan_nodes(plan["Plan"])), plan["Execution Time"]
+
+    def explain_all(self, cursor):
+        results = []
+        for name, sql in QUERIES:
+            results.append(self.explain(cursor, sql.format(table=TABLE)))
+        return results
+
+    def index_definitions(self, cursor):
+        """ Returns the CREATE INDEX statements for the subscriptions
+            table's indexes, other than the primary key, rewritten for the
+            benchmark table
+        """
+        table = Subscription._meta.db_table
+        cursor.execute(
+            "SELECT indexname, indexdef FROM pg_indexes "
+            "WHERE tablename = %s AND indexdef NOT LIKE '%%UNIQUE%%'",
+            [table])
+        definitions = []
+        for name, definition in cursor.fetchall():
+            definition = re.sub(
+                r"INDEX \S+ ON \S+",
+                "INDEX %s ON %s" % (name.replace(table, TABLE), TABLE),
+                definition, count=1)
+            definitions.append(definition)
+        return definitions
+
+    def handle(self, *args, **options):
+        table = Subscription._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "CREATE TEMPORARY TABLE %s "
+                "(LIKE %s INCLUDING DEFAULTS)" % (TABLE, table))
+            try:
+                self.stdout.write("Generating %d subscriptions" % (
+                    options["rows"],))
+                start = time.time()
+                # Run without parameters, so the % operators are left alone
+                cursor.execute(FILL_SQL.format(
+                    table=TABLE, rows=options["rows"]))
+                cursor.execute("ANALYZE %s" % TABLE)
+                self.stdout.write("Generated in %.1fs" % (
+                    time.time() - start))
+
+                without = self.explain_all(cursor)
+                for definition in self.index_definitions(cursor):
+                    cursor.execute(definition)
+                cursor.execute("ANALYZE %s" % TABLE)
+                with_indexes = self.explain_all(cursor)
+            finally:
+                cursor.execute("DROP TABLE IF EXISTS %s" % TABLE)
+
+        for (name, sql), before, after in zip(QUERIES, without,
+                                              with_indexes):
+            self.stdout.write(
+                "%-24s %-24s %10.1f ms -> %-24s %10.1f ms" % (
+                    name, before[0], before[1], after[0], after[1]))
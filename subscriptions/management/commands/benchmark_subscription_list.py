@@ -0,0 +1,74 @@
+import time
+import uuid
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIRequestFactory
+
+from contentstore.models import MessageSet
+from subscriptions.models import Subscription
+from subscriptions.serializers import (SubscriptionSerializer,
+                                       SubscriptionRowSerializer)
+
+
+class Command(BaseCommand):
+    help = ("Compares the time to build and render a page of the "
+            "subscriptions list with SubscriptionSerializer and with the "
+            "values() path the list uses. The subscriptions are created in "
+            "a transaction that is rolled back.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--rows", type=int, default=1000,
+            help="Number of subscriptions on the page")
+        parser.add_argument(
+            "--repeat", type=int, default=10,
+            help="Times to build the page with each serializer")
+
+    def serializer_page(self, subscriptions, request):
+        return SubscriptionSerializer(
+            subscriptions, many=True, context={"request": request}).data
+
+    def row_page(self, subscriptions, request):
+        serializer = SubscriptionRowSerializer.for_request(request)
+        rows = subscriptions.values(*SubscriptionRowSerializer.value_fields)
+        return [serializer.to_representation(row) for row in rows]
+
+    def time_page(self, build, subscriptions, request, repeat):
+        renderer = JSONRenderer()
+        start = time.time()
+        for i in range(repeat):
+            content = renderer.render(build(subscriptions, request))
+        return (time.time() - start) * 1000 / repeat, content
+
+    def handle(self, *args, **options):
+        messageset = MessageSet.objects.first()
+        if messageset is None:
+            raise CommandError("There are no messagesets to subscribe to")
+        request = APIRequestFactory().get("/api/v1/subscriptions/")
+        identity = str(uuid.uuid4())
+        subscriptions = Subscription.objects.filter(
+            identity=identity).order_by("created_at", "pk")
+
+        with transaction.atomic():
+            Subscription.objects.bulk_create([
+                Subscription(
+                    identity=identity,
+                    messageset=messageset, lang="en_ZA",
+                    schedule_id=messageset.default_schedule_id,
+                    metadata={"source": "benchmark"})
+                for i in range(options["rows"])])
+
+            serializer_ms, serializer_content = self.time_page(
+                self.serializer_page, subscriptions, request,
+                options["repeat"])
+            row_ms, row_content = self.time_page(
+                self.row_page, subscriptions, request, options["repeat"])
+            transaction.set_rollback(True)
+
+        self.stdout.write("SubscriptionSerializer %10.1f ms" % serializer_ms)
+        self.stdout.write("values() rows          %10.1f ms" % row_ms)
+        self.stdout.write("Speedup %.1fx, output %s" % (
+            serializer_ms / row_ms,
+            "identical" if row_content == serializer_content else "DIFFERENT"))
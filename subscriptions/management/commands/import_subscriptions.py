@@ -0,0 +1,41 @@
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from subscriptions.imports import READERS, InvalidImport, import_subscriptions
+
+
+class Command(BaseCommand):
+    help = ("Creates subscriptions from a JSON lines or CSV file, validating "
+            "and inserting them a chunk at a time. Scheduler registration "
+            "and the created metric are queued once per chunk.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("path")
+        parser.add_argument(
+            "--format", choices=sorted(READERS.keys()),
+            help="File format, by default taken from the file extension")
+        parser.add_argument(
+            "--chunk-size", type=int,
+            default=settings.SUBSCRIPTION_BATCH_SIZE,
+            help="Rows to validate and insert at a time")
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        file_format = options["format"]
+        if file_format is None:
+            file_format = "csv" if path.lower().endswith(".csv") else "jsonl"
+
+        with open(path, "rb") as f:
+            try:
+                created, errors = import_subscriptions(
+                    READERS[file_format](f), options["chunk_size"])
+            except InvalidImport as e:
+                raise CommandError(str(e))
+
+        for error in errors:
+            self.stderr.write("Row %d: %s" % (
+                error["row"], json.dumps(error["errors"])))
+        self.stdout.write("Created %d subscriptions, %d rows invalid" % (
+            created, len(errors)))
@@ -0,0 +1,45 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from subscriptions.models import Subscription
+from subscriptions.tasks import send_next_message_batch
+
+
+class Command(BaseCommand):
+    help = ("Claims due subscriptions from the database in batches and sends "
+            "them, for the 'queue' SUBSCRIPTION_DISPATCH_MODE. Any number of "
+            "these workers can run at once without claiming the same "
+            "subscription twice. Needs PostgreSQL 9.5 or later.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size", type=int,
+            default=settings.SUBSCRIPTION_BATCH_SIZE,
+            help="Subscriptions to claim and send at a time")
+        parser.add_argument(
+            "--concurrency", type=int, default=None,
+            help="HTTP calls to have in flight at once")
+        parser.add_argument(
+            "--poll-interval", type=float, default=5.0,
+            help="Seconds to wait before checking an empty queue again")
+        parser.add_argument(
+            "--once", action="store_true", default=False,
+            help="Exit once the queue is empty instead of polling")
+
+    def handle(self, *args, **options):
+        count = 0
+        while True:
+            subscriptions = Subscription.objects.claim_due(
+                options["batch_size"])
+            if not subscriptions.exists():
+                if options["once"]:
+                    break
+                time.sleep(options["poll_interval"])
+                continue
+            result = send_next_message_batch.send_claimed(
+                subscriptions, options["concurrency"])
+            count += 1
+            self.stdout.write(result)
+        self.stdout.write("Processed %d batches" % count)
@@ -0,0 +1,43 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from seed_stage_based_messaging import utils
+from subscriptions.models import Subscription
+from subscriptions.tasks import send_next_message_batch
+
+
+class Command(BaseCommand):
+    help = ("Sends the next message to every active, idle subscription on "
+            "the given schedules from this process. The identity store and "
+            "message sender calls for up to --concurrency subscriptions are "
+            "in flight at once, which can't be more than HTTP_POOL_SIZE.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("schedule_ids", nargs="+", type=int)
+        parser.add_argument(
+            "--batch-size", type=int,
+            default=settings.SUBSCRIPTION_BATCH_SIZE,
+            help="Subscriptions to claim and send at a time")
+        parser.add_argument(
+            "--concurrency", type=int, default=settings.HTTP_POOL_SIZE,
+            help="HTTP calls to have in flight at once (default "
+                 "HTTP_POOL_SIZE)")
+
+    def handle(self, *args, **options):
+        if options["concurrency"] > settings.HTTP_POOL_SIZE:
+            # Calls beyond the pool size would each open a new connection
+            raise CommandError(
+                "--concurrency is more than HTTP_POOL_SIZE (%d), raise "
+                "HTTP_POOL_SIZE to match" % settings.HTTP_POOL_SIZE)
+        subscriptions = Subscription.objects.filter(
+            schedule_id__in=options["schedule_ids"], active=True,
+            completed=False, process_status=0)
+
+        count = 0
+        for batch in utils.id_chunks(subscriptions, options["batch_size"]):
+            result = send_next_message_batch.run(
+                [str(subscription_id) for subscription_id in batch],
+                concurrency=options["concurrency"])
+            count += len(batch)
+            self.stdout.write(result)
+        self.stdout.write("Processed %d subscriptions" % count)
@@ -0,0 +1,22 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from contentstore.models import Schedule
+from subscriptions.tasks import sync_schedule_trigger, sync_shared_schedule
+
+
+class Command(BaseCommand):
+    help = ("Creates or updates the celerybeat periodic task, or in the "
+            "'shared' mode the scheduler schedule, that sends the "
+            "subscriptions on each schedule. Run this after switching "
+            "SUBSCRIPTION_DISPATCH_MODE to 'schedule', 'queue' or 'shared'.")
+
+    def handle(self, *args, **options):
+        count = 0
+        for schedule in Schedule.objects.all():
+            if settings.SUBSCRIPTION_DISPATCH_MODE == "shared":
+                sync_shared_schedule.run(schedule.id)
+            else:
+                sync_schedule_trigger(schedule)
+            count += 1
+        self.stdout.write("Synced triggers for %d schedules" % count)
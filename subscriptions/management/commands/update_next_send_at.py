@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from contentstore.models import Schedule
+from subscriptions.models import Subscription, next_send_time
+
+
+class Command(BaseCommand):
+    help = ("Sets next_send_at for every active, idle subscription to the "
+            "next time its schedule fires, with one UPDATE per schedule. "
+            "Only the queue dispatch mode uses next_send_at.")
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        count = 0
+        for schedule in Schedule.objects.all():
+            count += Subscription.objects.filter(
+                schedule=schedule, active=True, completed=False,
+                process_status=0).update(
+                    next_send_at=next_send_time(schedule, now))
+        self.stdout.write("Updated %d subscriptions" % count)
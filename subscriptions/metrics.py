@@ -0,0 +1,88 @@
+"""
+Buffering of sum metrics.
+
+With METRICS_BUFFER_INTERVAL set, increments are added up in this process
+and fired together in one metrics API call at most every
+METRICS_BUFFER_INTERVAL seconds, instead of queueing a fire_metric task for
+each one. A worker process flushes what it has left when it shuts down.
+"""
+import atexit
+import os
+import threading
+
+from celery.signals import worker_process_shutdown
+from celery.utils.log import get_task_logger
+from django.conf import settings
+
+logger = get_task_logger(__name__)
+
+
+class MetricsBuffer(object):
+
+    """ Sums of sum metric increments waiting to be fired
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+        self.timer = None
+        self.pid = os.getpid()
+
+    def add(self, metric_name, metric_value, interval):
+        with self.lock:
+            if self.pid != os.getpid():
+                # Forked, the parent process fires what it had
+                self.values = {}
+                self.timer = None
+                self.pid = os.getpid()
+            self.values[metric_name] = \
+                self.values.get(metric_name, 0.0) + metric_value
+            if self.timer is None:
+                self.timer = threading.Timer(interval, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        """ Fires all the buffered sums in one metrics API call
+        """
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            values, self.values = self.values, {}
+        if not values:
+            return {}
+        from .tasks import get_metric_client
+        try:
+            get_metric_client().fire(values)
+        except Exception:
+            logger.error('Failed firing buffered metrics %r' % (values,),
+                         exc_info=True)
+        return values
+
+
+buffer = MetricsBuffer()
+
+
+def increment(metric_name, metric_value=1.0):
+    """ Adds metric_value to a sum metric, buffering it if
+        METRICS_BUFFER_INTERVAL is set and otherwise firing it with a
+        fire_metric task
+    """
+    if settings.METRICS_BUFFER_INTERVAL > 0:
+        buffer.add(metric_name, float(metric_value),
+                   settings.METRICS_BUFFER_INTERVAL)
+    else:
+        from .tasks import fire_metric
+        fire_metric.apply_async(kwargs={
+            "metric_name": metric_name,
+            "metric_value": float(metric_value)
+        })
+
+
+@worker_process_shutdown.connect
+def flush_on_shutdown(**kwargs):
+    buffer.flush()
+
+
+atexit.register(buffer.flush)
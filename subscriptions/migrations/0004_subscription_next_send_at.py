@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.1 on 2026-10-17 09:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('subscriptions', '0003_auto_20160322_1534'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='subscription',
+            name='next_send_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('subscriptions', '0004_subscription_next_send_at'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='subscription',
+            name='next_send_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        # Only active, incomplete subscriptions are ever due, so keep them
+        # alone in the index the dispatcher range scans
+        migrations.RunSQL(
+            "CREATE INDEX subscriptions_subscription_due "
+            "ON subscriptions_subscription (next_send_at) "
+            "WHERE active AND NOT completed",
+            "DROP INDEX subscriptions_subscription_due"),
+    ]
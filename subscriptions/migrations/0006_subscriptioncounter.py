@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.1 on 2026-10-17 12:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contentstore', '0006_schedule_scheduler_schedule_id'),
+        ('subscriptions', '0005_subscription_due_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SubscriptionCounter',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bucket', models.CharField(choices=[('created', 'Created'), ('active', 'Active'), ('completed', 'Completed'), ('broken', 'Broken')], max_length=20)),
+                ('count', models.BigIntegerField(default=0)),
+                ('messageset', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='subscription_counters', to='contentstore.MessageSet')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='subscriptioncounter',
+            unique_together=set([('messageset', 'bucket')]),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.1 on 2026-10-17 14:05
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('subscriptions', '0006_subscriptioncounter'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='subscription',
+            name='identity',
+            field=models.CharField(db_index=True, max_length=36),
+        ),
+        migrations.AlterIndexTogether(
+            name='subscription',
+            index_together=set([('messageset', 'active')]),
+        ),
+        # The subscriptions a schedule sends to are the idle, active ones,
+        # so only those are indexed by schedule
+        migrations.RunSQL(
+            "CREATE INDEX subscriptions_subscription_idle "
+            "ON subscriptions_subscription (schedule_id) "
+            "WHERE active AND NOT completed AND process_status = 0",
+            "DROP INDEX subscriptions_subscription_idle"),
+        # Most subscriptions are idle with process_status 0, so only the
+        # in process, finished and broken ones are worth indexing
+        migrations.RunSQL(
+            "CREATE INDEX subscriptions_subscription_status "
+            "ON subscriptions_subscription (process_status) "
+            "WHERE process_status <> 0",
+            "DROP INDEX subscriptions_subscription_status"),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.1 on 2026-10-17 15:20
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('subscriptions', '0007_subscription_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='subscription',
+            index_together=set([('messageset', 'active'),
+                                ('created_at', 'id')]),
+        ),
+    ]
@@ -1,14 +1,104 @@
+import logging
 import uuid
 
+from django.conf import settings
 from django.contrib.postgres.fields import JSONField
-from django.db import models
-from django.db.models.signals import post_save
+from django.db import connection, models
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
+from django.utils import timezone
 from django.contrib.auth.models import User
 from django.utils.encoding import python_2_unicode_compatible
 
 from contentstore.models import MessageSet, Schedule
 
+logger = logging.getLogger(__name__)
+
+
+def next_send_time(schedule, now=None):
+    """ Returns the next time schedule fires after now, for next_send_at.
+        Only the queue dispatch mode reads next_send_at, so in the other
+        modes, or if the schedule can't be worked out locally, returns None.
+    """
+    if settings.SUBSCRIPTION_DISPATCH_MODE != "queue":
+        return None
+    try:
+        return schedule.next_run(now or timezone.now())
+    except ValueError as e:
+        logger.warning("No next send time for schedule %s: %s" % (
+            schedule.id, e))
+        return None
+
+
+class SubscriptionManager(models.Manager):
+
+    CLAIM_SQL = (
+        "UPDATE {table} SET process_status = 1 "
+        "WHERE id = ANY(%s::uuid[]) AND process_status = 0 "
+        "AND active AND NOT completed "
+        "RETURNING {columns}")
+
+    def claim(self, subscription_id):
+        """ Moves a ready, active subscription to in process
+            (process_status 1) with a single UPDATE and returns it, or None if
+            it was not ready. Only one caller can claim a subscription.
+        """
+        claimed = list(self.raw(
+            self.CLAIM_SQL.format(table=self.model._meta.db_table,
+                                  columns="*"),
+            [[str(subscription_id)]]))
+        return claimed[0] if claimed else None
+
+    def claim_many(self, subscription_ids):
+        """ Claims all the ready, active subscriptions in subscription_ids
+            with a single UPDATE, returning a queryset of the ones claimed
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(
+                self.CLAIM_SQL.format(table=self.model._meta.db_table,
+                                      columns="id"),
+                [[str(subscription_id)
+                  for subscription_id in subscription_ids]])
+            claimed = [row[0] for row in cursor.fetchall()]
+        return self.filter(id__in=claimed)
+
+    def complete_many(self, subscription_ids):
+        """ Completes the in process subscriptions in subscription_ids with a
+            single UPDATE, returning the ids of the ones completed
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "UPDATE {table} SET completed = true, active = false, "
+                "process_status = 2, next_send_at = NULL "
+                "WHERE id = ANY(%s::uuid[]) AND process_status = 1 "
+                "RETURNING id".format(table=self.model._meta.db_table),
+                [[str(subscription_id)
+                  for subscription_id in subscription_ids]])
+            return [row[0] for row in cursor.fetchall()]
+
+    def claim_due(self, limit, now=None):
+        """ Claims up to limit ready, active subscriptions that are due to
+            be sent, oldest first, clearing next_send_at. Rows other workers
+            are claiming are skipped rather than waited on, so many workers
+            can drain the queue at once. Needs PostgreSQL 9.5 or later.
+        """
+        if now is None:
+            now = timezone.now()
+        table = self.model._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "UPDATE {table} SET process_status = 1, next_send_at = NULL "
+                "WHERE id IN ("
+                "SELECT id FROM {table} "
+                "WHERE next_send_at <= %s AND process_status = 0 "
+                "AND active AND NOT completed "
+                "ORDER BY next_send_at LIMIT %s "
+                "FOR UPDATE SKIP LOCKED) "
+                "RETURNING id".format(table=table),
+                [now, limit])
+            claimed = [row[0] for row in cursor.fetchall()]
+        return self.filter(id__in=claimed)
+
 
 @python_2_unicode_compatible
 class Subscription(models.Model):
@@ -16,7 +106,8 @@ class Subscription(models.Model):
     """ Identity subscriptions and their status
     """
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
-    identity = models.CharField(max_length=36, null=False, blank=False)
+    identity = models.CharField(max_length=36, null=False, blank=False,
+                                db_index=True)
     version = models.IntegerField(default=1)
     messageset = models.ForeignKey(MessageSet, related_name='subscriptions',
                                    null=False)
@@ -28,6 +119,7 @@ class Subscription(models.Model):
     schedule = models.ForeignKey(Schedule, related_name='subscriptions',
                                  null=False)
     process_status = models.IntegerField(default=0, null=False, blank=False)
+    next_send_at = models.DateTimeField(null=True, blank=True)
     metadata = JSONField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -37,39 +129,123 @@ class Subscription(models.Model):
                                    null=True)
     user = property(lambda self: self.created_by)
 
+    objects = SubscriptionManager()
+
+    # The fields post_save compares with their values when loaded
+    TRACKED_FIELDS = ('messageset_id', 'active', 'completed', 'process_status')
+
+    _loaded_state = None
+
+    class Meta:
+        # For the per messageset active counts and keyset pagination. The
+        # partial indexes for sending are created in migrations.
+        index_together = [('messageset', 'active'), ('created_at', 'id')]
+
     def __str__(self):
         return str(self.id)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Subscription, cls).from_db(db, field_names, values)
+        if all(f in instance.__dict__ for f in cls.TRACKED_FIELDS):
+            instance._loaded_state = instance.tracked_state()
+        return instance
 
-# Make sure new subscriptions are created on scheduler
-@receiver(post_save, sender=Subscription)
-def fire_sub_action_if_new(sender, instance, created, **kwargs):
-    from .tasks import schedule_create
-    if created:
-        schedule_create.apply_async(args=[str(instance.id)])
+    def tracked_state(self):
+        return dict((f, getattr(self, f)) for f in self.TRACKED_FIELDS)
 
+    def save(self, *args, **kwargs):
+        if self.next_send_at is None and self.active and not self.completed:
+            self.next_send_at = next_send_time(self.schedule)
+        super(Subscription, self).save(*args, **kwargs)
 
-# Deactivate the schedule for this subscription when completed
-@receiver(post_save, sender=Subscription)
-def disable_schedule_if_complete(sender, instance, created, **kwargs):
-    from .tasks import schedule_disable
-    if instance.completed is True or instance.process_status == 2:
-        schedule_disable.apply_async(args=[str(instance.id)])
 
+@python_2_unicode_compatible
+class SubscriptionCounter(models.Model):
 
-# Deactivate the schedule for this subscription when deactivated
-@receiver(post_save, sender=Subscription)
-def disable_schedule_if_deactivated(sender, instance, created, **kwargs):
-    from .tasks import schedule_disable
-    if instance.active is False:
-        schedule_disable.apply_async(args=[str(instance.id)])
+    """ The number of subscriptions on a messageset in a bucket, kept up to
+        date as subscriptions change when SUBSCRIPTION_COUNTERS is on
+    """
+    BUCKETS = (
+        ('created', 'Created'),
+        ('active', 'Active'),
+        ('completed', 'Completed'),
+        ('broken', 'Broken'),
+    )
+
+    messageset = models.ForeignKey(MessageSet,
+                                   related_name='subscription_counters')
+    bucket = models.CharField(max_length=20, choices=BUCKETS)
+    count = models.BigIntegerField(default=0)
+
+    class Meta:
+        unique_together = (('messageset', 'bucket'),)
+
+    def __str__(self):
+        return "%s %s: %s" % (self.messageset_id, self.bucket, self.count)
+
+
+def is_finished(state):
+    return (state["active"] is False or state["completed"] is True or
+            state["process_status"] == 2)
 
 
+# Only act on changes: create the scheduler schedule and count new
+# subscriptions, and disable the schedule once a subscription completes or is
+# deactivated
 @receiver(post_save, sender=Subscription)
-def fire_metrics_if_new(sender, instance, created, **kwargs):
-    from .tasks import fire_metric
+def handle_subscription_save(sender, instance, created, **kwargs):
+    from .tasks import schedule_create, schedule_disable
+    from . import counters, metrics
+    previous = instance._loaded_state
+    current = instance.tracked_state()
+    instance._loaded_state = current
+
+    # Without loaded values there is nothing to count the change from
+    if created or previous is not None:
+        counters.record_change(previous, current)
+
     if created:
-        fire_metric.apply_async(kwargs={
-            "metric_name": 'subscriptions.created.sum',
-            "metric_value": 1.0
-        })
+        if settings.SUBSCRIPTION_DISPATCH_MODE == "subscription":
+            schedule_create.apply_async(args=[str(instance.id)])
+        metrics.increment('subscriptions.created.sum')
+
+    if is_finished(current) and (previous is None or
+                                 not is_finished(previous)):
+        schedule_disable.apply_async(args=[str(instance.id)])
+
+
+@receiver(post_delete, sender=Subscription)
+def count_deleted_subscription(sender, instance, **kwargs):
+    from . import counters
+    counters.record_change(instance.tracked_state(), None)
+
+
+# Keep a periodic send trigger for every schedule when dispatching by
+# schedule, or a scheduler schedule in the shared mode
+@receiver(post_save, sender=Schedule)
+def update_schedule_trigger(sender, instance, created, **kwargs):
+    from .tasks import sync_schedule_trigger, sync_shared_schedule
+    if settings.SUBSCRIPTION_DISPATCH_MODE in ("schedule", "queue"):
+        sync_schedule_trigger(instance)
+    elif settings.SUBSCRIPTION_DISPATCH_MODE == "shared":
+        sync_shared_schedule.apply_async(args=[instance.id])
+
+
+# Move the subscriptions on a schedule to its new next send time
+@receiver(post_save, sender=Schedule)
+def update_subscription_send_times(sender, instance, created, **kwargs):
+    if not created and settings.SUBSCRIPTION_DISPATCH_MODE == "queue":
+        Subscription.objects.filter(
+            schedule=instance, active=True, completed=False,
+            next_send_at__isnull=False).update(
+                next_send_at=next_send_time(instance))
+
+
+@receiver(post_delete, sender=Schedule)
+def delete_schedule_trigger(sender, instance, **kwargs):
+    from .tasks import remove_schedule_trigger, disable_shared_schedule
+    remove_schedule_trigger(instance.id)
+    if instance.scheduler_schedule_id:
+        disable_shared_schedule.apply_async(
+            args=[instance.scheduler_schedule_id])
@@ -1,6 +1,10 @@
+from collections import OrderedDict
+
 from rest_framework import serializers
+from rest_framework.reverse import reverse
 
 from .models import Subscription
+from contentstore.models import MessageSet, Schedule
 
 
 class CreateUserSerializer(serializers.Serializer):
@@ -16,3 +20,93 @@ class SubscriptionSerializer(serializers.ModelSerializer):
             'url', 'id', 'version', 'identity', 'messageset',
             'next_sequence_number', 'lang', 'active', 'completed', 'schedule',
             'process_status', 'metadata', 'created_at', 'updated_at')
+
+
+class SubscriptionRowSerializer(object):
+
+    """ Turns subscription rows from values(*value_fields) into the same
+        dicts as SubscriptionSerializer, without building and running a
+        serializer field per value. The url is only included when the
+        serializer is made with for_request(), which reverses it once.
+    """
+    fields = (
+        'id', 'version', 'identity', 'messageset', 'next_sequence_number',
+        'lang', 'active', 'completed', 'schedule', 'process_status',
+        'metadata', 'created_at', 'updated_at')
+    # The values() names, which are the same but for the foreign keys
+    value_fields = tuple(
+        field + '_id' if field in ('messageset', 'schedule') else field
+        for field in fields)
+
+    # Reversed in place of an id to find the rest of the url
+    URL_MARKER = '00000000-0000-0000-0000-000000000000'
+
+    def __init__(self, url_prefix=None, url_suffix=''):
+        self.url_prefix = url_prefix
+        self.url_suffix = url_suffix
+
+    @classmethod
+    def for_request(cls, request, format=None):
+        """ Returns a serializer that gives each row the url
+            SubscriptionSerializer would for request
+        """
+        url = reverse('subscription-detail', kwargs={'pk': cls.URL_MARKER},
+                      request=request, format=format)
+        url_prefix, url_suffix = url.rsplit(cls.URL_MARKER, 1)
+        return cls(url_prefix, url_suffix)
+
+    def to_representation(self, row):
+        data = OrderedDict()
+        subscription_id = str(row['id'])
+        if self.url_prefix is not None:
+            data['url'] = self.url_prefix + subscription_id + self.url_suffix
+        for field, value_field in zip(self.fields, self.value_fields):
+            data[field] = row[value_field]
+        data['id'] = subscription_id
+        data['created_at'] = format_datetime(data['created_at'])
+        data['updated_at'] = format_datetime(data['updated_at'])
+        return data
+
+
+def format_datetime(value):
+    """ Formats a datetime the way serializers.DateTimeField does with the
+        default ISO 8601 format
+    """
+    if value is None:
+        return None
+    value = value.isoformat()
+    if value.endswith('+00:00'):
+        value = value[:-6] + 'Z'
+    return value
+
+
+class CachedPrimaryKeyRelatedField(serializers.PrimaryKeyRelatedField):
+
+    """ Looks each related object up once per serializer context, since the
+        rows of an import only refer to a handful of them
+    """
+
+    def to_internal_value(self, data):
+        related = self.context.setdefault("related", {})
+        key = (self.field_name, data)
+        try:
+            hash(key)
+        except TypeError:
+            return super(
+                CachedPrimaryKeyRelatedField, self).to_internal_value(data)
+        if key not in related:
+            related[key] = super(
+                CachedPrimaryKeyRelatedField, self).to_internal_value(data)
+        return related[key]
+
+
+class SubscriptionImportSerializer(serializers.ModelSerializer):
+    messageset = CachedPrimaryKeyRelatedField(
+        queryset=MessageSet.objects.all())
+    schedule = CachedPrimaryKeyRelatedField(queryset=Schedule.objects.all())
+
+    class Meta:
+        model = Subscription
+        fields = (
+            'identity', 'messageset', 'next_sequence_number', 'lang',
+            'active', 'completed', 'schedule', 'process_status', 'metadata')
@@ -1,4 +1,3 @@
-import requests
 import json
 try:
     from urlparse import urlunparse
@@ -11,18 +10,28 @@ from celery.exceptions import SoftTimeLimitExceeded
 
 from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
+from django.db import transaction
+from django.contrib.postgres.fields import JSONField
+from django.db.models import Case, F, When
+from django.db.models.expressions import RawSQL
+from django.utils import timezone
 from django.contrib.sites.shortcuts import get_current_site
+from djcelery.models import CrontabSchedule, PeriodicTask
 from go_http.metrics import MetricsApiClient
 
-from .models import Subscription
+from . import counters, metrics
+from .models import Subscription, SubscriptionCounter, next_send_time
 from seed_stage_based_messaging import utils
-from contentstore.models import Message, MessageSet
+from contentstore.models import MessageSet, MessageSetLength, Schedule
+from contentstore.cache import get_message_content, get_message_contents
 from scheduler.client import SchedulerApiClient
 
 logger = get_task_logger(__name__)
 
 
 def get_metric_client(session=None):
+    if session is None:
+        session = utils.get_session("metrics")
     return MetricsApiClient(
         auth_token=settings.METRICS_AUTH_TOKEN,
         api_url=settings.METRICS_URL,
@@ -39,6 +48,178 @@ def make_absolute_url(path):
          '', '', ''))
 
 
+def get_recipient_address(identity):
+    """ Returns the address messages for an identity should be sent to,
+        following communicate_through if it is set, or None if there is
+        no valid address
+    """
+    initial_id = utils.get_identity(identity)
+    if "communicate_through" in initial_id and \
+            initial_id["communicate_through"] is not None:
+        # we should not send messages to this ID. Load listed ID.
+        return utils.get_identity_address(initial_id["communicate_through"])
+    return utils.get_identity_address(identity)
+
+
+def build_message_payload(subscription, message, to_addr):
+    """ Builds the message sender payload for sending message, the content
+        returned by get_message_content, to subscription. Any
+        prepend_next_delivery in the subscription metadata is used up, so the
+        second value returned says whether the subscription metadata needs
+        saving.
+    """
+    payload = {
+        "to_addr": to_addr,
+        "delivered": "false",
+        "metadata": {}
+    }
+    prepend = None
+    if subscription.metadata is not None:
+        prepend = subscription.metadata.get("prepend_next_delivery")
+
+    if subscription.messageset.content_type == "text":
+        if prepend is not None:
+            payload["content"] = "%s\n%s" % (
+                prepend, message["text_content"])
+        else:
+            payload["content"] = message["text_content"]
+    else:
+        # TODO - audio media handling on MC
+        # audio
+        speech_url = make_absolute_url(message["binary_content_url"])
+        if prepend is not None:
+            payload["metadata"]["voice_speech_url"] = [prepend, speech_url]
+        else:
+            payload["metadata"]["voice_speech_url"] = speech_url
+
+    if prepend is not None:
+        # clear prepend_next_delivery
+        subscription.metadata["prepend_next_delivery"] = None
+        return payload, True
+    return payload, False
+
+
+def send_outbound(payload):
+    """ Submits a message to the message sender, returning the created
+        outbound
+    """
+    return utils.message_sender_session().post(
+        url="%s/outbound/" % settings.MESSAGE_SENDER_URL,
+        data=json.dumps(payload)
+    ).json()
+
+
+def send_outbounds(payloads, concurrency=None):
+    """ Submits many messages to the message sender, at most concurrency
+        (default settings.MESSAGE_SENDER_CONCURRENCY) at a time. Returns the
+        created outbound for each payload in order, or None for payloads that
+        were not accepted.
+    """
+    if concurrency is None:
+        concurrency = settings.MESSAGE_SENDER_CONCURRENCY
+
+    def submit(payload):
+        r = utils.message_sender_session().post(
+            url="%s/outbound/" % settings.MESSAGE_SENDER_URL,
+            data=json.dumps(payload))
+        r.raise_for_status()
+        return r.json()
+
+    results = utils.map_concurrently(submit, payloads, concurrency)
+    outbounds = []
+    for payload, result in zip(payloads, results):
+        if isinstance(result, Exception):
+            logger.error('Failed sending to Message Sender for <%s>: %r' % (
+                payload["to_addr"], result))
+            outbounds.append(None)
+        else:
+            outbounds.append(result)
+    return outbounds
+
+
+def next_send_times(schedule_ids, now=None):
+    """ Returns the next_send_at for each schedule in schedule_ids, the
+        next time it fires after now in the queue dispatch mode
+    """
+    if now is None:
+        now = timezone.now()
+    schedules = Schedule.objects.in_bulk(set(schedule_ids))
+    return dict((schedule_id, next_send_time(schedule, now))
+                for schedule_id, schedule in schedules.items())
+
+
+def reschedule_subscriptions(subscriptions, filters=None, **updates):
+    """ Applies updates to subscriptions, also setting next_send_at to the
+        next time their schedule fires, with one UPDATE per schedule. Only
+        rows that also match filters are changed.
+    """
+    by_schedule = {}
+    for subscription in subscriptions:
+        by_schedule.setdefault(subscription.schedule_id, []).append(
+            subscription.id)
+    send_times = next_send_times(by_schedule.keys())
+    for schedule_id, ids in by_schedule.items():
+        Subscription.objects.filter(id__in=ids, **(filters or {})).update(
+            next_send_at=send_times[schedule_id], **updates)
+
+
+def advance_subscriptions(subscriptions):
+    """ Moves subscriptions that have just been sent a message on to their
+        next message, or completes them and creates their next set
+        subscription, the same way PostSendProcess does. Uses conditional
+        UPDATEs (one per schedule for the advancing subscriptions) in a single
+        transaction, and only changes subscriptions that are still in
+        process. Next set subscriptions are only created for the
+        subscriptions the completing UPDATE returns.
+    """
+    set_lengths = MessageSetLength.objects.lengths(set(
+        (s.messageset_id, s.lang) for s in subscriptions))
+    advancing = []
+    completed = []
+    for subscription in subscriptions:
+        set_max = set_lengths[(subscription.messageset_id, subscription.lang)]
+        if subscription.next_sequence_number == set_max:
+            completed.append(subscription)
+        else:
+            advancing.append(subscription)
+
+    with transaction.atomic():
+        if advancing:
+            reschedule_subscriptions(
+                advancing, filters={"process_status": 1},
+                next_sequence_number=F('next_sequence_number') + 1,
+                process_status=0)
+
+        if completed:
+            # Only the subscriptions this call completed get a next set
+            completed_ids = set(str(subscription_id) for subscription_id in
+                                Subscription.objects.complete_many(
+                                    [s.id for s in completed]))
+            completed = [s for s in completed if str(s.id) in completed_ids]
+            deltas = {}
+            for subscription in completed:
+                for bucket, change in (("active", -1), ("completed", 1)):
+                    key = (subscription.messageset_id, bucket)
+                    deltas[key] = deltas.get(key, 0) + change
+            counters.apply_deltas(deltas)
+            for subscription in completed:
+                next_set = subscription.messageset.next_set
+                if next_set:
+                    logger.info("Creating new subscription for next set")
+                    newsub = Subscription.objects.create(
+                        identity=subscription.identity,
+                        lang=subscription.lang,
+                        messageset=next_set,
+                        schedule=next_set.default_schedule
+                    )
+                    logger.debug("Created Subscription <%s>" % newsub.id)
+
+    if completed:
+        # update() skips the post_save schedule disabling
+        schedule_disable_batch.apply_async(
+            args=[[str(subscription.id) for subscription in completed]])
+
+
 class FireMetric(Task):
 
     """ Fires a metric using the MetricsApiClient
@@ -78,102 +259,44 @@ class SendNextMessage(Task):
         """
         l = self.get_logger(**kwargs)
 
-        l.info("Loading Subscription")
+        l.info("Claiming Subscription")
         try:
-            subscription = Subscription.objects.get(id=subscription_id)
-            # start here
-            if subscription.process_status == 0 and \
-               subscription.completed is not True and \
-               subscription.active is True:
-
-                l.debug("setting process status to 1")
-                subscription.process_status = 1  # in process
-                l.debug("saving subscription")
-                subscription.save()
+            # start here, moving a ready subscription to in process (1)
+            subscription = Subscription.objects.claim(subscription_id)
+            if subscription is not None:
                 l.info("Loading Message")
-                message = Message.objects.get(
-                    messageset=subscription.messageset,
-                    sequence_number=subscription.next_sequence_number,
-                    lang=subscription.lang)
+                message = get_message_content(
+                    subscription.messageset_id,
+                    subscription.next_sequence_number,
+                    subscription.lang)
 
                 l.info("Loading Initial Recipient Identity")
-                to_addr = None
-                initial_id = utils.get_identity(subscription.identity)
-                if "communicate_through" in initial_id and \
-                        initial_id["communicate_through"] is not None:
-                    # we should not send messages to this ID. Load listed ID.
-                    to_addr = utils.get_identity_address(
-                        initial_id["communicate_through"])
-                else:
-                    # set recipient data
-                    to_addr = utils.get_identity_address(subscription.identity)
+                to_addr = get_recipient_address(subscription.identity)
                 l.debug("to_addr determined - %s" % to_addr)
 
                 if to_addr is not None:
-                    l.info("Preparing message payload with: %s" % message.id)  # noqa
-                    payload = {
-                        "to_addr": to_addr,
-                        "delivered": "false",
-                        "metadata": {}
-                    }
-                    if subscription.messageset.content_type == "text":
-                        l.debug("Determining payload content")
-                        if subscription.metadata is not None and \
-                           "prepend_next_delivery" in subscription.metadata \
-                           and subscription.metadata["prepend_next_delivery"] is not None:  # noqa
-                            l.debug("Prepending next delivery")
-                            payload["content"] = "%s\n%s" % (
-                                subscription.metadata["prepend_next_delivery"],
-                                message.text_content)
-                            # clear prepend_next_delivery
-                            l.debug("Clearing prepended message")
-                            subscription.metadata[
-                                "prepend_next_delivery"] = None
-                            subscription.save()
-                        else:
-                            l.debug("Loading default content")
-                            payload["content"] = message.text_content
-                        l.debug("text content loaded")
-                    else:
-                        # TODO - audio media handling on MC
-                        # audio
-
-                        if subscription.metadata is not None and \
-                           "prepend_next_delivery" in subscription.metadata \
-                           and subscription.metadata["prepend_next_delivery"] is not None:  # noqa
-                            payload["metadata"]["voice_speech_url"] = [
-                                subscription.metadata["prepend_next_delivery"],
-                                make_absolute_url(
-                                    message.binary_content.content.url),
-                            ]
-                            # clear prepend_next_delivery
-                            subscription.metadata[
-                                "prepend_next_delivery"] = None
-                            subscription.save()
-                        else:
-                            payload["metadata"]["voice_speech_url"] = \
-                                make_absolute_url(
-                                    message.binary_content.content.url)
+                    l.info("Preparing message payload with: %s" % message["id"])  # noqa
+                    payload, metadata_changed = build_message_payload(
+                        subscription, message, to_addr)
+                    if metadata_changed:
+                        l.debug("Clearing prepended message")
+                        subscription.save()
 
                     l.info("Sending message to Message Sender")
-                    result = requests.post(
-                        url="%s/outbound/" % settings.MESSAGE_SENDER_URL,
-                        data=json.dumps(payload),
-                        headers={
-                            'Content-Type': 'application/json',
-                            'Authorization': 'Token %s' % (
-                                settings.MESSAGE_SENDER_TOKEN,)
-                        }
-                    ).json()
+                    result = send_outbound(payload)
 
-                    l.debug("setting process status back to 0")
-                    subscription.process_status = 0  # ready
-                    l.debug("saving subscription")
-                    subscription.save()
+                    if settings.SUBSCRIPTION_FUSED_POST_SEND:
+                        l.debug("advancing subscription")
+                        advance_subscriptions([subscription])
+                    else:
+                        l.debug("setting process status back to 0")
+                        subscription.process_status = 0  # ready
+                        l.debug("saving subscription")
+                        subscription.save()
 
-                    l.debug("firing post_send_process task")
-                    post_send_process.apply_async(args=[subscription_id])
-                    l.debug("fired post_send_process task")
+                        l.debug("firing post_send_process task")
+                        post_send_process.apply_async(args=[subscription_id])
+                        l.debug("fired post_send_process task")
 
                     l.debug("Message queued for send. ID: <%s>" % str(result["id"]))  # noqa
                     return "Message queued for send. ID: <%s>" % str(result["id"])  # noqa
@@ -183,15 +306,14 @@ class SendNextMessage(Task):
                     l.debug("saving subscription")
                     subscription.save()
                     l.debug("Firing error metric")
-                    fire_metric.apply_async(kwargs={
-                        "metric_name": 'subscriptions.send_next_message_errored.sum',  # noqa
-                        "metric_value": 1.0
-                    })
+                    metrics.increment(
+                        'subscriptions.send_next_message_errored.sum')
                     l.debug("Fired error metric")
                     return "Valid recipient could not be found"
 
-            elif (subscription.process_status == 2 or
-                  subscription.completed is True):
+            subscription = Subscription.objects.get(id=subscription_id)
+            if (subscription.process_status == 2 or
+                    subscription.completed is True):
                 # Disable the subscription's scheduler
                 schedule_disable.apply_async(subscription.id)
                 l.info("Scheduler deactivation task fired")
@@ -217,6 +339,199 @@ class SendNextMessage(Task):
 send_next_message = SendNextMessage()
 
 
+class SendNextMessageBatch(Task):
+
+    """
+    Task to send the next message for each of a batch of subscriptions,
+    using a fixed number of queries for the whole batch
+    """
+    name = "subscriptions.tasks.send_next_message_batch"
+
+    def load_messages(self, subscriptions):
+        """ Returns the next message content for each subscription keyed by
+            (messageset_id, sequence_number, lang)
+        """
+        return get_message_contents(set(
+            (s.messageset_id, s.next_sequence_number, s.lang)
+            for s in subscriptions))
+
+    def run(self, subscription_ids, concurrency=None, **kwargs):
+        """
+        concurrency overrides the number of identity store lookups and
+        message sender submissions in flight at once
+        """
+        l = self.get_logger(**kwargs)
+        l.info("Claiming batch of %d subscriptions" % len(subscription_ids))
+        subscriptions = Subscription.objects.claim_many(subscription_ids)
+        return self.send_claimed(subscriptions, concurrency, **kwargs)
+
+    def send_claimed(self, subscriptions, concurrency=None, **kwargs):
+        """
+        Sends to a queryset of subscriptions that have already been claimed
+        """
+        l = self.get_logger(**kwargs)
+        subscriptions = list(subscriptions.select_related(
+            'messageset', 'messageset__next_set', 'schedule'))
+        if not subscriptions:
+            return "0 sent, 0 errored, 0 skipped"
+        messages = self.load_messages(subscriptions)
+
+        sent = []
+        errored = []
+        skipped = []
+        to_send = []
+        payloads = []
+        with_message = []
+        for subscription in subscriptions:
+            message = messages.get((subscription.messageset_id,
+                                    subscription.next_sequence_number,
+                                    subscription.lang))
+            if message is None:
+                logger.error('Missing Message for subscription <%s>' % (
+                    subscription.id,))
+                skipped.append(subscription)
+            else:
+                with_message.append((subscription, message))
+
+        # Only look up the identities that have a message to send
+        addresses = {}
+        if with_message:
+            addresses = utils.get_identity_addresses(
+                [s.identity for s, message in with_message], concurrency)
+
+        for subscription, message in with_message:
+            if subscription.identity not in addresses:
+                logger.error('Failed looking up identity for subscription '
+                             '<%s>' % (subscription.id,))
+                skipped.append(subscription)
+                continue
+            to_addr = addresses[subscription.identity]
+            if to_addr is None:
+                l.info("No valid recipient to_addr found for <%s>" % (
+                    subscription.id,))
+                errored.append(subscription)
+                continue
+
+            payload, metadata_changed = build_message_payload(
+                subscription, message, to_addr)
+            to_send.append((subscription, metadata_changed))
+            payloads.append(payload)
+
+        l.info("Sending %d messages to Message Sender" % len(payloads))
+        outbounds = send_outbounds(payloads, concurrency)
+        for (subscription, metadata_changed), outbound in zip(to_send,
+                                                              outbounds):
+            if outbound is None:
+                skipped.append(subscription)
+                continue
+            if metadata_changed:
+                Subscription.objects.filter(id=subscription.id).update(
+                    metadata=subscription.metadata)
+            sent.append(subscription)
+
+        if skipped:
+            # Leave these ready to be retried on the next send
+            reschedule_subscriptions(skipped, process_status=0)
+
+        if errored:
+            Subscription.objects.filter(
+                id__in=[s.id for s in errored]).update(process_status=-1)
+            counters.record_changes(
+                (s.tracked_state(), dict(s.tracked_state(), process_status=-1))
+                for s in errored)
+            metrics.increment('subscriptions.send_next_message_errored.sum',
+                              len(errored))
+
+        if sent:
+            advance_subscriptions(sent)
+
+        return "%d sent, %d errored, %d skipped" % (
+            len(sent), len(errored), len(skipped))
+
+send_next_message_batch = SendNextMessageBatch()
+
+
+class SendSchedule(Task):
+
+    """
+    Task to send the next message to all the active, idle subscriptions on
+    a schedule, in batches of settings.SUBSCRIPTION_BATCH_SIZE
+    """
+    name = "subscriptions.tasks.send_schedule"
+
+    def run(self, schedule_id, **kwargs):
+        l = self.get_logger(**kwargs)
+        if settings.SUBSCRIPTION_DISPATCH_MODE == "queue":
+            # process_send_queue workers pick these up
+            queued = Subscription.objects.filter(
+                schedule_id=schedule_id, active=True, completed=False,
+                process_status=0, next_send_at=None).update(
+                    next_send_at=timezone.now())
+            l.info("Queued %d subscriptions for schedule <%s>" % (
+                queued, schedule_id))
+            return "%d subscriptions queued" % queued
+
+        l.info("Dispatching subscriptions for schedule <%s>" % schedule_id)
+        subscriptions = Subscription.objects.filter(
+            schedule_id=schedule_id, active=True, completed=False,
+            process_status=0)
+
+        dispatched = 0
+        batches = 0
+        for batch in utils.id_chunks(subscriptions,
+                                     settings.SUBSCRIPTION_BATCH_SIZE):
+            send_next_message_batch.apply_async(
+                args=[[str(subscription_id) for subscription_id in batch]])
+            dispatched += len(batch)
+            batches += 1
+
+        l.info("Dispatched %d subscriptions in %d batches" % (
+            dispatched, batches))
+        return "%d subscriptions dispatched in %d batches" % (
+            dispatched, batches)
+
+send_schedule = SendSchedule()
+
+
+def schedule_trigger_name(schedule_id):
+    return "Send subscriptions for schedule %s" % schedule_id
+
+
+def sync_schedule_trigger(schedule):
+    """
+    Creates or updates the celerybeat periodic task that fires send_schedule
+    for this schedule
+    """
+    minute, hour, day_of_week, day_of_month, month_of_year = \
+        schedule.cron_string.split()
+    crontab_fields = {
+        "minute": minute,
+        "hour": hour,
+        "day_of_week": day_of_week,
+        "day_of_month": day_of_month,
+        "month_of_year": month_of_year,
+    }
+    crontab = CrontabSchedule.objects.filter(**crontab_fields).first()
+    if crontab is None:
+        crontab = CrontabSchedule.objects.create(**crontab_fields)
+    name = schedule_trigger_name(schedule.id)
+    trigger = PeriodicTask.objects.filter(name=name).first()
+    if trigger is None:
+        trigger = PeriodicTask(name=name)
+    trigger.task = send_schedule.name
+    trigger.crontab = crontab
+    trigger.interval = None
+    trigger.args = json.dumps([schedule.id])
+    trigger.enabled = True
+    trigger.save()
+    return trigger
+
+
+def remove_schedule_trigger(schedule_id):
+    PeriodicTask.objects.filter(
+        name=schedule_trigger_name(schedule_id)).delete()
+
+
 class PostSendProcess(Task):
 
     """
@@ -237,18 +552,14 @@ class PostSendProcess(Task):
         """
         l = self.get_logger(**kwargs)
 
-        l.info("Loading Subscription")
+        l.info("Claiming Subscription")
         # Process moving to next message, next set or finished
         try:
-            subscription = Subscription.objects.get(id=subscription_id)
-            if subscription.process_status == 0:
-                l.debug("setting process status to 1")
-                subscription.process_status = 1  # in process
-                l.debug("saving subscription")
-                subscription.save()
+            subscription = Subscription.objects.claim(subscription_id)
+            if subscription is not None:
                 # Get set max
-                set_max = subscription.messageset.messages.filter(
-                    lang=subscription.lang).count()
+                set_max = MessageSetLength.objects.length(
+                    subscription.messageset_id, subscription.lang)
                 l.debug("set_max calculated - %s" % set_max)
                 # Compare user position to max
                 if subscription.next_sequence_number == set_max:
@@ -259,6 +570,7 @@ class PostSendProcess(Task):
                     subscription.active = False
                     l.debug("setting process status to 2")
                     subscription.process_status = 2  # Completed
+                    subscription.next_send_at = None
                     l.debug("saving subscription")
                     subscription.save()
                     # If next set defined create new subscription
@@ -278,6 +590,8 @@ class PostSendProcess(Task):
                     subscription.next_sequence_number += 1
                     l.debug("setting process status back to 0")
                     subscription.process_status = 0
+                    subscription.next_send_at = next_send_time(
+                        subscription.schedule)
                     l.debug("saving subscription")
                     subscription.save()
                 # return response
@@ -314,7 +628,8 @@ class ScheduleDisable(Task):
     def scheduler_client(self):
         return SchedulerApiClient(
             api_token=settings.SCHEDULER_API_TOKEN,
-            api_url=settings.SCHEDULER_URL)
+            api_url=settings.SCHEDULER_URL,
+            session=utils.get_session("scheduler"))
 
     def run(self, subscription_id, **kwargs):
         l = self.get_logger(**kwargs)
@@ -355,7 +670,8 @@ class ScheduleCreate(Task):
     def scheduler_client(self):
         return SchedulerApiClient(
             api_token=settings.SCHEDULER_API_TOKEN,
-            api_url=settings.SCHEDULER_URL)
+            api_url=settings.SCHEDULER_URL,
+            session=utils.get_session("scheduler"))
 
     def schedule_to_cron(self, schedule):
         return "%s %s %s %s %s" % (
@@ -366,6 +682,17 @@ class ScheduleCreate(Task):
             schedule.day_of_week
         )
 
+    def scheduler_schedule(self, subscription):
+        """ Returns the scheduler schedule that sends to subscription
+        """
+        return {
+            "frequency": None,
+            "cron_definition": self.schedule_to_cron(subscription.schedule),
+            "endpoint": "%s/%s/send" % (
+                settings.STAGE_BASED_MESSAGING_URL, subscription.id),
+            "auth_token": settings.SCHEDULER_INBOUND_API_TOKEN
+        }
+
     def run(self, subscription_id, **kwargs):
         """ Returns remote scheduler_id UUID
         """
@@ -375,14 +702,7 @@ class ScheduleCreate(Task):
         try:
             subscription = Subscription.objects.get(id=subscription_id)
             if subscription.process_status == 0:
-                schedule = {
-                    "frequency": None,
-                    "cron_definition":
-                        self.schedule_to_cron(subscription.schedule),
-                    "endpoint": "%s/%s/send" % (
-                        settings.STAGE_BASED_MESSAGING_URL, subscription_id),
-                    "auth_token": settings.SCHEDULER_INBOUND_API_TOKEN
-                }
+                schedule = self.scheduler_schedule(subscription)
                 scheduler = self.scheduler_client()
                 result = scheduler.create_schedule(schedule)
                 l.info("Created schedule <%s> on scheduler for sub <%s>" % (
@@ -408,6 +728,142 @@ class ScheduleCreate(Task):
 schedule_create = ScheduleCreate()
 
 
+def set_scheduler_schedule_ids(subscriptions, schedule_ids):
+    """ Saves each created scheduler schedule id in its subscription's
+        metadata, with a single UPDATE. The id is merged into the metadata in
+        the database, so other changes to the metadata are kept.
+    """
+    whens = []
+    for subscription, schedule_id in zip(subscriptions, schedule_ids):
+        whens.append(When(id=subscription.id, then=RawSQL(
+            "COALESCE(metadata, '{}'::jsonb) || "
+            "jsonb_build_object('scheduler_schedule_id', %s::text)",
+            (schedule_id,), output_field=JSONField())))
+    if whens:
+        Subscription.objects.filter(
+            id__in=[s.id for s in subscriptions]).update(
+                metadata=Case(*whens, output_field=JSONField()))
+
+
+class ScheduleCreateBatch(Task):
+
+    """ Task to tell scheduler about many new subscriptions, for bulk
+        imports that skip the per subscription post_save task
+    """
+    name = "seed_stage_based_messaging.subscriptions.tasks.schedule_create_batch"  # noqa
+
+    def run(self, subscription_ids, **kwargs):
+        l = self.get_logger(**kwargs)
+        l.info("Creating schedules for %d subscriptions" % (
+            len(subscription_ids),))
+        subscriptions = list(Subscription.objects.filter(
+            id__in=subscription_ids, process_status=0).select_related(
+                'schedule'))
+        results = schedule_create.scheduler_client().create_schedules(
+            [schedule_create.scheduler_schedule(s) for s in subscriptions],
+            concurrency=settings.SCHEDULER_CONCURRENCY)
+
+        created = []
+        for subscription, result in zip(subscriptions, results):
+            if isinstance(result, Exception):
+                logger.error('Failed creating schedule for <%s>: %r' % (
+                    subscription.id, result))
+            else:
+                created.append((subscription, result["id"]))
+        set_scheduler_schedule_ids(
+            [c[0] for c in created], [c[1] for c in created])
+        return "Created %d schedules" % len(created)
+
+schedule_create_batch = ScheduleCreateBatch()
+
+
+class ScheduleDisableBatch(Task):
+
+    """ Task to disable the schedules of many subscriptions, for when they
+        are completed or deactivated in bulk
+    """
+    name = "seed_stage_based_messaging.subscriptions.tasks.schedule_disable_batch"  # noqa
+
+    def run(self, subscription_ids, **kwargs):
+        l = self.get_logger(**kwargs)
+        l.info("Disabling schedules for %d subscriptions" % (
+            len(subscription_ids),))
+        schedule_ids = []
+        for metadata in Subscription.objects.filter(
+                id__in=subscription_ids).values_list('metadata', flat=True):
+            if metadata and metadata.get("scheduler_schedule_id"):
+                schedule_ids.append(metadata["scheduler_schedule_id"])
+        results = schedule_disable.scheduler_client().disable_schedules(
+            schedule_ids, concurrency=settings.SCHEDULER_CONCURRENCY)
+
+        disabled = 0
+        for schedule_id, result in zip(schedule_ids, results):
+            if isinstance(result, Exception):
+                logger.error('Failed disabling schedule <%s>: %r' % (
+                    schedule_id, result))
+            else:
+                disabled += 1
+        return "Disabled %d schedules" % disabled
+
+schedule_disable_batch = ScheduleDisableBatch()
+
+
+class SyncSharedSchedule(Task):
+
+    """ Task to create or update the scheduler schedule that sends to all
+        the subscriptions on a contentstore Schedule, for the "shared"
+        dispatch mode
+    """
+    name = "seed_stage_based_messaging.subscriptions.tasks.sync_shared_schedule"  # noqa
+
+    def run(self, schedule_id, **kwargs):
+        l = self.get_logger(**kwargs)
+        try:
+            schedule = Schedule.objects.get(id=schedule_id)
+        except ObjectDoesNotExist:
+            logger.error('Missing Schedule', exc_info=True)
+            return False
+
+        remote = {
+            "frequency": None,
+            "cron_definition": schedule_create.schedule_to_cron(schedule),
+            "endpoint": "%s/schedule/%s/send" % (
+                settings.STAGE_BASED_MESSAGING_URL, schedule.id),
+            "auth_token": settings.SCHEDULER_INBOUND_API_TOKEN
+        }
+        scheduler = schedule_create.scheduler_client()
+        if schedule.scheduler_schedule_id:
+            scheduler.update_schedule(schedule.scheduler_schedule_id, remote)
+            l.info("Updated shared schedule <%s> for schedule <%s>" % (
+                schedule.scheduler_schedule_id, schedule.id))
+            return schedule.scheduler_schedule_id
+
+        result = scheduler.create_schedule(remote)
+        # update() so that saving the id does not sync again
+        Schedule.objects.filter(id=schedule.id).update(
+            scheduler_schedule_id=result["id"])
+        l.info("Created shared schedule <%s> for schedule <%s>" % (
+            result["id"], schedule.id))
+        return result["id"]
+
+sync_shared_schedule = SyncSharedSchedule()
+
+
+class DisableSharedSchedule(Task):
+
+    """ Task to disable the shared scheduler schedule of a deleted
+        contentstore Schedule
+    """
+    name = "seed_stage_based_messaging.subscriptions.tasks.disable_shared_schedule"  # noqa
+
+    def run(self, scheduler_schedule_id, **kwargs):
+        schedule_disable.scheduler_client().update_schedule(
+            scheduler_schedule_id, {"enabled": False})
+        return "Disabled shared schedule <%s>" % scheduler_schedule_id
+
+disable_shared_schedule = DisableSharedSchedule()
+
+
 class ScheduledMetrics(Task):
 
     """ Fires off tasks for all the metrics that should run
@@ -433,7 +889,7 @@ class FireActiveLast(Task):
     name = "seed_stage_based_messaging.subscriptions.tasks.fire_active_last"
 
     def run(self):
-        active_subs = Subscription.objects.filter(active=True).count()
+        active_subs = counters.count("active")
         return fire_metric.apply_async(kwargs={
             "metric_name": 'subscriptions.active.last',
             "metric_value": active_subs
@@ -449,7 +905,7 @@ class FireCreatedLast(Task):
     name = "seed_stage_based_messaging.subscriptions.tasks.fire_created_last"
 
     def run(self):
-        created_subs = Subscription.objects.all().count()
+        created_subs = counters.count("created")
         return fire_metric.apply_async(kwargs={
             "metric_name": 'subscriptions.created.last',
             "metric_value": created_subs
@@ -465,7 +921,7 @@ class FireBrokenLast(Task):
     name = "seed_stage_based_messaging.subscriptions.tasks.fire_broken_last"
 
     def run(self):
-        broken_subs = Subscription.objects.filter(process_status=-1).count()
+        broken_subs = counters.count("broken")
         return fire_metric.apply_async(kwargs={
             "metric_name": 'subscriptions.broken.last',
             "metric_value": broken_subs
@@ -481,7 +937,7 @@ class FireCompletedLast(Task):
     name = "seed_stage_based_messaging.subscriptions.tasks.fire_completed_last"  # noqa
 
     def run(self):
-        completed_subs = Subscription.objects.filter(completed=True).count()
+        completed_subs = counters.count("completed")
         return fire_metric.apply_async(kwargs={
             "metric_name": 'subscriptions.completed.last',
             "metric_value": completed_subs
@@ -515,11 +971,68 @@ class FireMessageSetLast(Task):
     name = "seed_stage_based_messaging.subscriptions.tasks.fire_messageset_last"  # noqa
 
     def run(self, msgset_id, short_name, **kwargs):
-        active_msgset_subs = Subscription.objects.filter(
-            messageset=msgset_id, active=True).count()
+        active_msgset_subs = counters.count("active", msgset_id)
         return fire_metric.apply_async(kwargs={
             "metric_name": 'subscriptions.%s.active.last' % short_name,
             "metric_value": active_msgset_subs
         })
 
 fire_messageset_last = FireMessageSetLast()
+
+
+class FireSubscriptionMetrics(Task):
+
+    """ Fires all the scheduled subscription counts, including the active
+        count for each messageset, in a single metrics call. They are all
+        counted with one grouped query, or read from the subscription
+        counters when SUBSCRIPTION_COUNTERS is on.
+    """
+    name = "seed_stage_based_messaging.subscriptions.tasks.fire_subscription_metrics"  # noqa
+
+    def run(self, **kwargs):
+        if settings.SUBSCRIPTION_COUNTERS:
+            # Messagesets without counter rows yet have zero counts
+            totals = dict(
+                (row['short_name'],
+                 dict((bucket, 0) for bucket in counters.BUCKET_FILTERS))
+                for row in MessageSet.objects.values('short_name'))
+            for row in SubscriptionCounter.objects.values(
+                    'messageset__short_name', 'bucket', 'count'):
+                totals[row['messageset__short_name']][row['bucket']] = \
+                    row['count']
+            counts = [dict(short_name=short_name, **buckets)
+                      for short_name, buckets in totals.items()]
+        else:
+            counts = MessageSet.objects.order_by().values(
+                'short_name').annotate(
+                    **counters.bucket_aggregates(prefix="subscriptions__"))
+
+        values = {
+            'subscriptions.active.last': 0.0,
+            'subscriptions.created.last': 0.0,
+            'subscriptions.broken.last': 0.0,
+            'subscriptions.completed.last': 0.0,
+        }
+        for row in counts:
+            for count in ('active', 'created', 'broken', 'completed'):
+                values['subscriptions.%s.last' % count] += row[count]
+            values['subscriptions.%s.active.last' % row['short_name']] = \
+                float(row['active'])
+        get_metric_client().fire(values)
+        return "Fired %d metrics" % len(values)
+
+fire_subscription_metrics = FireSubscriptionMetrics()
+
+
+class ReconcileSubscriptionCounters(Task):
+
+    """ Recounts the subscription counters from the subscriptions table
+    """
+    name = "seed_stage_based_messaging.subscriptions.tasks.reconcile_subscription_counters"  # noqa
+
+    def run(self, **kwargs):
+        if not settings.SUBSCRIPTION_COUNTERS:
+            return "Subscription counters are off"
+        return "%d counters corrected" % counters.reconcile()
+
+reconcile_subscription_counters = ReconcileSubscriptionCounters()
@@ -1,5 +1,9 @@
+import os
 import responses
 import json
+import tempfile
+from collections import OrderedDict
+from datetime import timedelta
 
 try:
     from urllib.parse import urlparse
@@ -8,22 +12,36 @@ except ImportError:
 
 from django.contrib.auth.models import User
 from django.test import TestCase, override_settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.utils.six import StringIO
 from django.db.models.signals import post_save
 from django.conf import settings
+from django.db import connection
+from django.utils import timezone
 
 from rest_framework import status
+from rest_framework.renderers import JSONRenderer
 from rest_framework.test import APIClient
 from rest_framework.authtoken.models import Token
 from requests_testadapter import TestAdapter, TestSession
 from go_http.metrics import MetricsApiClient
+from djcelery.models import PeriodicTask
 
-from .models import (Subscription, fire_sub_action_if_new,
-                     disable_schedule_if_complete,
-                     disable_schedule_if_deactivated, fire_metrics_if_new)
+from .models import Subscription, handle_subscription_save
 from contentstore.models import Schedule, MessageSet, BinaryContent, Message
+from contentstore import cache as content_cache
+from contentstore import cron
 from .tasks import (schedule_create, schedule_disable, fire_metric,
-                    scheduled_metrics)
-from . import tasks
+                    scheduled_metrics, send_schedule,
+                    send_next_message_batch, send_next_message,
+                    schedule_create_batch, schedule_disable_batch)
+from . import counters, metrics, tasks
+from .export import iter_rows
+from .serializers import SubscriptionSerializer
+from seed_stage_based_messaging import utils
+from seed_stage_based_messaging.pagination import encode_cursor
 
 
 class RecordingAdapter(TestAdapter):
@@ -138,6 +156,53 @@ class AuthenticatedAPITestCase(APITestCase):
         }
         return Subscription.objects.create(**post_data)
 
+    def mock_identity_lookups(self, identity, address="+2345059992222"):
+        responses.add(
+            responses.GET,
+            "http://seed-identity-store/api/v1/identities/%s/addresses/msisdn?default=True" % (identity, ),  # noqa
+            json={
+                "count": 1,
+                "next": None,
+                "previous": None,
+                "results": [{"address": address}]
+            },
+            status=200, content_type='application/json',
+            match_querystring=True
+        )
+        responses.add(
+            responses.GET,
+            "http://seed-identity-store/api/v1/identities/%s/" % (identity, ),
+            json={
+                "id": identity,
+                "version": 1,
+                "details": {
+                    "default_addr_type": "msisdn",
+                    "addresses": {
+                        "msisdn": {
+                            address: {}
+                        }
+                    },
+                },
+            },
+            status=200, content_type='application/json',
+        )
+
+    def mock_outbound(self):
+        responses.add(
+            responses.POST,
+            "http://seed-message-sender/api/v1/outbound/",
+            json={
+                "id": "c7f3c839-2bf5-42d1-86b9-ccb886645fb4",
+            },
+            status=200, content_type='application/json'
+        )
+
+    def make_messages(self, messageset, count):
+        for i in range(1, count + 1):
+            Message.objects.create(
+                messageset=messageset, sequence_number=i, lang="en_ZA",
+                text_content="This is message %s" % i)
+
     def _replace_get_metric_client(self, session=None):
         return MetricsApiClient(
             auth_token=settings.METRICS_AUTH_TOKEN,
@@ -156,11 +221,7 @@ class AuthenticatedAPITestCase(APITestCase):
         assert has_listeners(), (
             "Subscription model has no post_save listeners. Make sure"
             " helpers cleaned up properly in earlier tests.")
-        post_save.disconnect(fire_sub_action_if_new, sender=Subscription)
-        post_save.disconnect(disable_schedule_if_complete, sender=Subscription)
-        post_save.disconnect(disable_schedule_if_deactivated,
-                             sender=Subscription)
-        post_save.disconnect(fire_metrics_if_new, sender=Subscription)
+        post_save.disconnect(handle_subscription_save, sender=Subscription)
         assert not has_listeners(), (
             "Subscription model still has post_save listeners. Make sure"
             " helpers cleaned up properly in earlier tests.")
@@ -171,16 +232,28 @@ class AuthenticatedAPITestCase(APITestCase):
         assert not has_listeners(), (
             "Subscription model still has post_save listeners. Make sure"
             " helpers removed them properly in earlier tests.")
-        post_save.connect(fire_sub_action_if_new, sender=Subscription)
-        post_save.connect(disable_schedule_if_complete, sender=Subscription)
-        post_save.connect(disable_schedule_if_deactivated, sender=Subscription)
-        post_save.connect(fire_metrics_if_new, sender=Subscription)
+        post_save.connect(handle_subscription_save, sender=Subscription)
+
+    def _connect_post_save_hook(self):
+        """ Connects the Subscription post_save handling for a test, taking
+            the created metrics it fires through the test session
+        """
+        if self.session is not None:
+            self.session.mount("http://metrics-url/metrics/",
+                               TestAdapter(b"{}"))
+        post_save.connect(handle_subscription_save, sender=Subscription)
+
+    def _disconnect_post_save_hook(self):
+        post_save.disconnect(handle_subscription_save, sender=Subscription)
 
     def setUp(self):
         super(AuthenticatedAPITestCase, self).setUp()
 
         self._replace_post_save_hooks()
         tasks.get_metric_client = self._replace_get_metric_client
+        cache.clear()
+        content_cache.clear_local()
+        cron.clear()
 
         self.username = 'testuser'
         self.password = 'testpass'
@@ -299,6 +372,132 @@ class TestSubscriptionsAPI(AuthenticatedAPITestCase):
         self.assertEqual(response.data["count"], 1)
         self.assertEqual(response.data["results"][0]["id"], str(sub_active.id))
 
+    def test_list_subscriptions_by_cursor(self):
+        # Setup
+        ids = sorted(str(self.make_subscription().id) for i in range(3))
+        # Rows created together are ordered by id
+        Subscription.objects.update(created_at=timezone.now())
+
+        # Execute
+        first = self.client.get(
+            '/api/v1/subscriptions/',
+            {"active": "True", "cursor": "", "limit": 2},
+            content_type='application/json')
+        second = self.client.get(first.data["next"],
+                                 content_type='application/json')
+
+        # Check
+        self.assertEqual(first.status_code, status.HTTP_200_OK)
+        self.assertNotIn("count", first.data)
+        self.assertEqual([r["id"] for r in first.data["results"]], ids[:2])
+        self.assertEqual(second.status_code, status.HTTP_200_OK)
+        self.assertEqual([r["id"] for r in second.data["results"]], ids[2:])
+        self.assertEqual(second.data["next"], None)
+
+    def test_list_subscriptions_invalid_cursor(self):
+        response = self.client.get(
+            '/api/v1/subscriptions/', {"cursor": "nonsense"},
+            content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_list_subscriptions_invalid_cursor_pk(self):
+        response = self.client.get(
+            '/api/v1/subscriptions/',
+            {"cursor": encode_cursor(timezone.now(), "not-a-uuid")},
+            content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_list_matches_serializer(self):
+        # Setup
+        for i in range(3):
+            self.make_subscription()
+
+        # Execute
+        response = self.client.get(
+            '/api/v1/subscriptions/', {"cursor": ""},
+            content_type='application/json')
+
+        # Check
+        serializer = SubscriptionSerializer(
+            Subscription.objects.order_by("created_at", "pk"), many=True,
+            context={"request": response.wsgi_request})
+        expected = JSONRenderer().render(OrderedDict([
+            ("next", None), ("results", serializer.data)]))
+        self.assertEqual(response.content, expected)
+
+    def test_benchmark_list_command(self):
+        out = StringIO()
+
+        call_command("benchmark_subscription_list", "--rows", "5",
+                     "--repeat", "1", stdout=out)
+
+        lines = out.getvalue().strip().split("\n")
+        self.assertTrue(lines[-1].endswith("output identical"))
+        self.assertEqual(Subscription.objects.count(), 0)
+
+    def test_export_subscriptions(self):
+        # Setup
+        self.make_subscription()
+        self.make_subscription()
+        inactive = self.make_subscription()
+        inactive.active = False
+        inactive.save()
+        listed = self.client.get(
+            '/api/v1/subscriptions/', {"active": "True", "cursor": ""},
+            content_type='application/json')
+
+        # Execute
+        response = self.client.get('/api/v1/subscriptions/export/',
+                                   {"active": "True"})
+
+        # Check
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        lines = b"".join(response.streaming_content).decode("utf-8")
+        rows = [json.loads(line) for line in lines.splitlines()]
+        expected = []
+        for row in listed.data["results"]:
+            row = dict(row)
+            del row["url"]
+            expected.append(row)
+        self.assertEqual(rows, expected)
+
+    def test_export_subscriptions_csv(self):
+        # Setup
+        existing = self.make_subscription()
+
+        # Execute
+        response = self.client.get('/api/v1/subscriptions/export/',
+                                   {"output": "csv"})
+
+        # Check
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response["Content-Type"], "text/csv")
+        content = b"".join(response.streaming_content).decode("utf-8")
+        header, row = content.splitlines()
+        self.assertTrue(header.startswith("id,version,identity,messageset,"))
+        self.assertTrue(row.startswith("%s,1,%s,%s," % (
+            existing.id, existing.identity, self.messageset.id)))
+        self.assertIn('"{""source"": ""RapidProVoice""}"', row)
+
+    def test_export_unsupported_output(self):
+        response = self.client.get('/api/v1/subscriptions/export/',
+                                   {"output": "xml"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_export_reads_in_chunks(self):
+        # Setup
+        for i in range(3):
+            self.make_subscription()
+
+        # Execute
+        with self.assertNumQueries(2):
+            rows = list(iter_rows(Subscription.objects.all(), chunk_size=2))
+
+        # Check
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(len(set(row["id"] for row in rows)), 3)
+
     def test_update_subscription_data(self):
         # Setup
         existing = self.make_subscription()
@@ -332,6 +531,61 @@ class TestSubscriptionsAPI(AuthenticatedAPITestCase):
         self.assertEqual(d, 0)
 
 
+class TestClaimSubscription(AuthenticatedAPITestCase):
+
+    def test_claim(self):
+        # Setup
+        existing = self.make_subscription()
+
+        # Execute
+        claimed = Subscription.objects.claim(existing.id)
+
+        # Check
+        self.assertEqual(claimed.id, existing.id)
+        self.assertEqual(claimed.process_status, 1)
+        self.assertEqual(claimed.messageset, self.messageset)
+        self.assertEqual(
+            Subscription.objects.get(id=existing.id).process_status, 1)
+        self.assertEqual(Subscription.objects.claim(existing.id), None)
+
+    def test_claim_not_ready(self):
+        # Setup
+        inactive = self.make_subscription()
+        inactive.active = False
+        inactive.save()
+        completed = self.make_subscription()
+        completed.completed = True
+        completed.save()
+        broken = self.make_subscription()
+        broken.process_status = -1
+        broken.save()
+
+        # Execute and check
+        for subscription in (inactive, completed, broken):
+            self.assertEqual(
+                Subscription.objects.claim(subscription.id), None)
+
+    def test_claim_many(self):
+        # Setup
+        first = self.make_subscription()
+        second = self.make_subscription()
+        busy = self.make_subscription()
+        busy.process_status = 1
+        busy.save()
+
+        # Execute
+        claimed = Subscription.objects.claim_many(
+            [first.id, str(second.id), busy.id])
+
+        # Check
+        self.assertEqual(sorted(s.id for s in claimed),
+                         sorted([first.id, second.id]))
+        self.assertEqual(Subscription.objects.filter(
+            process_status=1).count(), 3)
+        self.assertEqual(list(Subscription.objects.claim_many(
+            [first.id, second.id])), [])
+
+
 class TestCreateScheduleTask(AuthenticatedAPITestCase):
 
     @responses.activate
@@ -450,6 +704,86 @@ class TestCreateScheduleTask(AuthenticatedAPITestCase):
         self.assertEqual(len(responses.calls), 1)
 
 
+class TestScheduleBatchTasks(AuthenticatedAPITestCase):
+
+    def schedule_created(self, request):
+        # the scheduler schedule gets the id of the subscription it sends to
+        endpoint = json.loads(request.body)["endpoint"]
+        return (201, {}, json.dumps({"id": endpoint.split("/")[-2]}))
+
+    @responses.activate
+    def test_schedule_create_batch(self):
+        # Setup
+        responses.add_callback(
+            responses.POST, "http://seed-scheduler/api/v1/schedule/",
+            callback=self.schedule_created,
+            content_type='application/json')
+        first = self.make_subscription()
+        second = self.make_subscription()
+        busy = self.make_subscription()
+        Subscription.objects.filter(id=busy.id).update(process_status=1)
+
+        # Execute
+        result = schedule_create_batch.apply_async(
+            args=[[str(first.id), str(second.id), str(busy.id)]])
+
+        # Check
+        self.assertEqual(result.get(), "Created 2 schedules")
+        self.assertEqual(len(responses.calls), 2)
+        for subscription in [first, second]:
+            d = Subscription.objects.get(id=subscription.id)
+            self.assertEqual(d.metadata, {
+                "source": "RapidProVoice",
+                "scheduler_schedule_id": str(subscription.id),
+            })
+        self.assertEqual(Subscription.objects.get(id=busy.id).metadata,
+                         {"source": "RapidProVoice"})
+
+    @responses.activate
+    def test_schedule_create_batch_scheduler_error(self):
+        # Setup
+        responses.add(responses.POST,
+                      "http://seed-scheduler/api/v1/schedule/",
+                      status=500)
+        existing = self.make_subscription()
+
+        # Execute
+        result = schedule_create_batch.apply_async(
+            args=[[str(existing.id)]])
+
+        # Check
+        self.assertEqual(result.get(), "Created 0 schedules")
+        self.assertEqual(Subscription.objects.get(id=existing.id).metadata,
+                         {"source": "RapidProVoice"})
+
+    @responses.activate
+    def test_schedule_disable_batch(self):
+        # Setup
+        subscription_ids = []
+        for schedule_id in ["6455245a-028b-4fa1-82fc-6b639c4e7710",
+                            "6455245a-028b-4fa1-82fc-6b639c4e7711"]:
+            subscription = self.make_subscription()
+            subscription.metadata["scheduler_schedule_id"] = schedule_id
+            subscription.save()
+            subscription_ids.append(str(subscription.id))
+            responses.add(
+                responses.PATCH,
+                "http://seed-scheduler/api/v1/schedule/%s/" % schedule_id,
+                json.dumps({"enabled": False}),
+                status=200, content_type='application/json')
+        subscription_ids.append(str(self.make_subscription().id))
+
+        # Execute
+        result = schedule_disable_batch.apply_async(args=[subscription_ids])
+
+        # Check
+        self.assertEqual(result.get(), "Disabled 2 schedules")
+        self.assertEqual(len(responses.calls), 2)
+        for call in responses.calls:
+            self.assertEqual(json.loads(call.request.body),
+                             {"enabled": False})
+
+
 class TestSubscriptionsWebhookListener(AuthenticatedAPITestCase):
 
     def test_webhook_subscription_data_good(self):
@@ -516,11 +850,141 @@ class TestSubscriptionsWebhookListener(AuthenticatedAPITestCase):
                          {"identity": ["This field is required."]})
 
 
+class TestSubscriptionImport(AuthenticatedAPITestCase):
+
+    def import_row(self, **kwargs):
+        row = {
+            "identity": "8646b7bc-b511-4965-a90b-e1145e398703",
+            "messageset": self.messageset.id,
+            "lang": "en_ZA",
+            "schedule": self.schedule.id,
+        }
+        row.update(kwargs)
+        return row
+
+    def mock_metrics(self):
+        self.session = None
+        responses.add(responses.POST,
+                      "http://metrics-url/metrics/",
+                      json={"foo": "bar"},
+                      status=200, content_type='application/json')
+
+    @responses.activate
+    def test_bulk_import_jsonl(self):
+        # Setup
+        self.mock_metrics()
+        responses.add(responses.POST,
+                      "http://seed-scheduler/api/v1/schedule/",
+                      json={"id": "6455245a-028b-4fa1-82fc-6b639c4e7710"},
+                      status=200, content_type='application/json')
+        bad = self.import_row()
+        del bad["identity"]
+        body = "\n".join(json.dumps(row) for row in [
+            self.import_row(metadata={"source": "import"}),
+            bad,
+            self.import_row(identity="3f7c8851-5204-43f7-af7f-005059993333"),
+        ])
+
+        # Execute
+        response = self.client.post('/api/v1/subscriptions/bulk', body,
+                                    content_type='application/x-ndjson')
+
+        # Check
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.json(), {
+            "accepted": True,
+            "created": 2,
+            "errors": [
+                {"row": 2, "errors": {"identity": ["This field is required."]}}
+            ],
+        })
+        self.assertEqual(Subscription.objects.count(), 2)
+        # one schedule per subscription, one metric for the chunk
+        self.assertEqual(
+            [call.request.url for call in responses.calls], [
+                "http://seed-scheduler/api/v1/schedule/",
+                "http://seed-scheduler/api/v1/schedule/",
+                "http://metrics-url/metrics/",
+            ])
+        self.assertEqual(json.loads(responses.calls[2].request.body),
+                         {"subscriptions.created.sum": 2.0})
+        for subscription in Subscription.objects.all():
+            self.assertIsNone(subscription.next_send_at)
+            self.assertEqual(
+                subscription.metadata["scheduler_schedule_id"],
+                "6455245a-028b-4fa1-82fc-6b639c4e7710")
+        self.assertEqual(Subscription.objects.get(
+            identity="8646b7bc-b511-4965-a90b-e1145e398703").metadata[
+                "source"], "import")
+
+    def test_bulk_import_unsupported_content_type(self):
+        # Execute
+        response = self.client.post('/api/v1/subscriptions/bulk', "{}",
+                                    content_type='application/json')
+
+        # Check
+        self.assertEqual(response.status_code, 415)
+        self.assertEqual(Subscription.objects.count(), 0)
+
+    def test_bulk_import_invalid_json(self):
+        # Execute
+        response = self.client.post('/api/v1/subscriptions/bulk', "{",
+                                    content_type='application/x-ndjson')
+
+        # Check
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.json()["accepted"], False)
+
+    @responses.activate
+    @override_settings(SUBSCRIPTION_DISPATCH_MODE="schedule")
+    def test_import_subscriptions_command_csv(self):
+        # Setup
+        self.mock_metrics()
+        rows = [
+            "identity,messageset,lang,schedule,next_sequence_number,metadata",
+            "8646b7bc-b511-4965-a90b-e1145e398703,%s,en_ZA,%s,3,"
+            "\"{\"\"source\"\": \"\"import\"\"}\"" % (
+                self.messageset.id, self.schedule.id),
+            "3f7c8851-5204-43f7-af7f-005059993333,%s,en_ZA,%s,," % (
+                self.messageset.id, self.schedule.id),
+            "3f7c8851-5204-43f7-af7f-005059994444,999999,en_ZA,%s,," % (
+                self.schedule.id,),
+        ]
+        f = tempfile.NamedTemporaryFile(suffix=".csv", delete=False)
+        f.write("\n".join(rows).encode("utf-8"))
+        f.close()
+        out = StringIO()
+        err = StringIO()
+
+        # Execute
+        call_command("import_subscriptions", f.name, "--chunk-size", "2",
+                     stdout=out, stderr=err)
+        os.remove(f.name)
+
+        # Check
+        self.assertEqual(out.getvalue().strip(),
+                         "Created 2 subscriptions, 1 rows invalid")
+        self.assertTrue(err.getvalue().startswith("Row 3: "))
+        first = Subscription.objects.get(
+            identity="8646b7bc-b511-4965-a90b-e1145e398703")
+        self.assertEqual(first.next_sequence_number, 3)
+        self.assertEqual(first.metadata, {"source": "import"})
+        second = Subscription.objects.get(
+            identity="3f7c8851-5204-43f7-af7f-005059993333")
+        self.assertEqual(second.next_sequence_number, 1)
+        self.assertEqual(second.metadata, {})
+        # only the chunk with new subscriptions fires a metric, and no
+        # schedules are created in this dispatch mode
+        self.assertEqual(
+            [call.request.url for call in responses.calls],
+            ["http://metrics-url/metrics/"])
+
+
 class TestSendMessageTask(AuthenticatedAPITestCase):
 
     @responses.activate
     def test_send_message_task_to_mother_text(self):
-        post_save.connect(fire_sub_action_if_new, sender=Subscription)
+        self._connect_post_save_hook()
         # mock schedule sending
         responses.add(
             responses.POST,
@@ -666,7 +1130,7 @@ class TestSendMessageTask(AuthenticatedAPITestCase):
             lang=existing.lang).count()
         self.assertEqual(message_count, 3)
 
-        post_save.disconnect(fire_sub_action_if_new, sender=Subscription)
+        self._disconnect_post_save_hook()
 
     @responses.activate
     def test_send_message_task_to_mother_text_welcome(self):
@@ -766,12 +1230,12 @@ class TestSendMessageTask(AuthenticatedAPITestCase):
     @responses.activate
     def test_send_message_task_to_mother_text_last(self):
         # Setup
-        post_save.connect(disable_schedule_if_complete, sender=Subscription)
         schedule_id = "6455245a-028b-4fa1-82fc-6b639c4e7710"
         existing = self.make_subscription()
         existing.metadata["scheduler_schedule_id"] = schedule_id
         existing.next_sequence_number = 2  # fast forward to end
         existing.save()
+        self._connect_post_save_hook()
 
         # mock identity address lookup
         responses.add(
@@ -870,7 +1334,7 @@ class TestSendMessageTask(AuthenticatedAPITestCase):
         self.assertEqual(d.process_status, 2)
         self.assertEqual(len(responses.calls), 4)
 
-        post_save.disconnect(disable_schedule_if_complete, sender=Subscription)
+        self._disconnect_post_save_hook()
 
     @responses.activate
     def test_send_message_task_to_mother_text_in_process(self):
@@ -948,8 +1412,6 @@ class TestSendMessageTask(AuthenticatedAPITestCase):
         self.assertEqual(scheds_all.count(), 1)
         self.assertEqual(len(responses.calls), 0)
 
-        post_save.disconnect(fire_sub_action_if_new, sender=Subscription)
-
     @responses.activate
     def test_send_message_task_to_other_text(self):
         # Setup
@@ -1308,84 +1770,861 @@ class TestSendMessageTask(AuthenticatedAPITestCase):
             'http://example.com/foo')
 
 
-class TestDeactivateSubscription(AuthenticatedAPITestCase):
+class TestSendSchedule(AuthenticatedAPITestCase):
 
-    @responses.activate
-    def test_deactivation_deactivates_schedule(self):
+    def assertNextSendAt(self, next_send_at, before):
+        self.assertTrue(self.schedule.next_run(before) <= next_send_at <=
+                        self.schedule.next_run(timezone.now()))
+
+    @override_settings(SUBSCRIPTION_BATCH_SIZE=2)
+    def test_send_schedule_dispatches_batches(self):
         # Setup
-        post_save.connect(disable_schedule_if_deactivated, sender=Subscription)
-        schedule_id = "6455245a-028b-4fa1-82fc-6b639c4e7710"
-        sub = self.make_subscription()
-        sub.metadata["scheduler_schedule_id"] = schedule_id
-        sub.save()
+        self.make_subscription()
+        self.make_subscription()
+        self.make_subscription()
+        inactive = self.make_subscription()
+        inactive.active = False
+        inactive.save()
+        busy = self.make_subscription()
+        busy.process_status = 1
+        busy.save()
 
-        # mock schedule update
-        responses.add(
-            responses.PATCH,
-            "http://seed-scheduler/api/v1/schedule/%s/" % schedule_id,
-            json.dumps({"enabled": False}),
-            status=200, content_type='application/json')
+        # Execute
+        result = send_schedule.apply_async(args=[self.schedule.id])
 
+        # Check
+        self.assertEqual(result.get(),
+                         "3 subscriptions dispatched in 2 batches")
+
+    @override_settings(SUBSCRIPTION_DISPATCH_MODE="schedule")
+    def test_schedule_trigger_created_and_removed(self):
         # Execute
-        sub.active = False
-        sub.save()
+        schedule = Schedule.objects.create(
+            minute="0", hour="8", day_of_week="1,3")
+
         # Check
-        self.assertEqual(len(responses.calls), 1)
-        post_save.disconnect(disable_schedule_if_deactivated,
-                             sender=Subscription)
+        trigger = PeriodicTask.objects.get(
+            name=tasks.schedule_trigger_name(schedule.id))
+        self.assertEqual(trigger.task, "subscriptions.tasks.send_schedule")
+        self.assertEqual(json.loads(trigger.args), [schedule.id])
+        self.assertEqual(trigger.crontab.minute, "0")
+        self.assertEqual(trigger.crontab.hour, "8")
+        self.assertEqual(trigger.crontab.day_of_week, "1,3")
+        self.assertEqual(trigger.crontab.day_of_month, "*")
+
+        schedule_id = schedule.id
+        schedule.delete()
+        self.assertEqual(PeriodicTask.objects.filter(
+            name=tasks.schedule_trigger_name(schedule_id)).count(), 0)
+
+    @override_settings(SUBSCRIPTION_DISPATCH_MODE="schedule")
+    def test_schedule_trigger_updated(self):
+        # Setup
+        schedule = Schedule.objects.create(minute="0", hour="8")
 
+        # Execute
+        schedule.hour = "9"
+        schedule.save()
 
-class TestMetricsAPI(AuthenticatedAPITestCase):
+        # Check
+        triggers = PeriodicTask.objects.filter(
+            name=tasks.schedule_trigger_name(schedule.id))
+        self.assertEqual(triggers.count(), 1)
+        self.assertEqual(triggers[0].crontab.hour, "9")
 
-    def test_metrics_read(self):
+    @override_settings(SUBSCRIPTION_DISPATCH_MODE="queue")
+    def test_send_schedule_queues_subscriptions(self):
         # Setup
+        first = self.make_subscription()
+        second = self.make_subscription()
+        inactive = self.make_subscription()
+        inactive.active = False
+        inactive.save()
+        # as if created before next_send_at was kept up to date
+        Subscription.objects.update(next_send_at=None)
+
         # Execute
-        response = self.client.get('/api/metrics/',
-                                   content_type='application/json')
+        result = send_schedule.apply_async(args=[self.schedule.id])
+
         # Check
-        self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(
-            response.data["metrics_available"], [
-                'subscriptions.created.sum',
-                'subscriptions.send_next_message_errored.sum',
-                'subscriptions.active.last',
-                'subscriptions.created.last',
-                'subscriptions.broken.last',
-                'subscriptions.completed.last',
-                'subscriptions.messageset_one.active.last',
-                'subscriptions.messageset_two.active.last'
-            ]
-        )
+        self.assertEqual(result.get(), "2 subscriptions queued")
+        claimed = Subscription.objects.claim_due(10)
+        self.assertEqual(sorted(s.id for s in claimed),
+                         sorted([first.id, second.id]))
+        for subscription in claimed:
+            self.assertEqual(subscription.process_status, 1)
+            self.assertEqual(subscription.next_send_at, None)
+        self.assertEqual(list(Subscription.objects.claim_due(10)), [])
 
     @responses.activate
-    def test_post_metrics(self):
+    @override_settings(SUBSCRIPTION_DISPATCH_MODE="queue")
+    def test_process_send_queue_command(self):
         # Setup
-        # deactivate Testsession for this test
-        self.session = None
-        responses.add(responses.POST,
-                      "http://metrics-url/metrics/",
-                      json={"foo": "bar"},
-                      status=200, content_type='application/json')
+        before = timezone.now()
+        existing = self.make_subscription()
+        Subscription.objects.filter(id=existing.id).update(
+            next_send_at=existing.created_at)
+        self.make_messages(self.messageset, 2)
+        self.mock_identity_lookups(existing.identity)
+        self.mock_outbound()
+        out = StringIO()
+
         # Execute
-        response = self.client.post('/api/metrics/',
-                                    content_type='application/json')
+        call_command("process_send_queue", "--once", stdout=out)
+
         # Check
-        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
-        self.assertEqual(response.data["scheduled_metrics_initiated"], True)
+        self.assertEqual(out.getvalue().splitlines(), [
+            "1 sent, 0 errored, 0 skipped",
+            "Processed 1 batches",
+        ])
+        d = Subscription.objects.get(id=existing.id)
+        self.assertEqual(d.next_sequence_number, 2)
+        self.assertEqual(d.process_status, 0)
+        self.assertNextSendAt(d.next_send_at, before)
 
+    @override_settings(SUBSCRIPTION_DISPATCH_MODE="queue")
+    def test_new_subscription_next_send_at(self):
+        # Execute
+        before = timezone.now()
+        existing = self.make_subscription()
 
-class TestMetrics(AuthenticatedAPITestCase):
+        # Check
+        self.assertNextSendAt(existing.next_send_at, before)
+        self.assertEqual(Subscription.objects.claim_due(
+            10, now=existing.next_send_at - timedelta(minutes=1)).count(), 0)
+        self.assertEqual(list(Subscription.objects.claim_due(
+            10, now=existing.next_send_at)), [existing])
 
-    def check_request(
-            self, request, method, params=None, data=None, headers=None):
-        self.assertEqual(request.method, method)
-        if params is not None:
-            url = urlparse.urlparse(request.url)
-            qs = urlparse.parse_qsl(url.query)
-            self.assertEqual(dict(qs), params)
-        if headers is not None:
-            for key, value in headers.items():
-                self.assertEqual(request.headers[key], value)
+    def test_next_send_at_only_kept_in_queue_mode(self):
+        # Execute
+        existing = self.make_subscription()
+
+        # Check
+        self.assertIsNone(existing.next_send_at)
+
+    @override_settings(SUBSCRIPTION_DISPATCH_MODE="queue")
+    def test_unparseable_schedule_leaves_next_send_at_null(self):
+        # Setup
+        # as if saved before the cron fields were validated
+        self.schedule.day_of_week = "?"
+        Schedule.objects.filter(id=self.schedule.id).update(
+            day_of_week="?")
+
+        # Execute
+        existing = self.make_subscription()
+
+        # Check
+        self.assertIsNone(
+            Subscription.objects.get(id=existing.id).next_send_at)
+
+    @override_settings(SUBSCRIPTION_DISPATCH_MODE="queue")
+    def test_schedule_change_moves_next_send_at(self):
+        # Setup
+        existing = self.make_subscription()
+        completed = self.make_subscription()
+        Subscription.objects.filter(id=completed.id).update(
+            completed=True, active=False)
+
+        # Execute
+        before = timezone.now()
+        self.schedule.hour = "3"
+        self.schedule.save()
+
+        # Check
+        self.assertNextSendAt(
+            Subscription.objects.get(id=existing.id).next_send_at, before)
+        self.assertEqual(
+            Subscription.objects.get(id=completed.id).next_send_at,
+            completed.next_send_at)
+
+    @override_settings(SUBSCRIPTION_DISPATCH_MODE="queue")
+    def test_update_next_send_at_command(self):
+        # Setup
+        existing = self.make_subscription()
+        Subscription.objects.update(next_send_at=None)
+        out = StringIO()
+        before = timezone.now()
+
+        # Execute
+        call_command("update_next_send_at", stdout=out)
+
+        # Check
+        self.assertEqual(out.getvalue().strip(), "Updated 1 subscriptions")
+        self.assertNextSendAt(
+            Subscription.objects.get(id=existing.id).next_send_at, before)
+
+    @responses.activate
+    @override_settings(SUBSCRIPTION_DISPATCH_MODE="shared")
+    def test_shared_schedule_synced(self):
+        # Setup
+        scheduler_schedule_id = "6455245a-028b-4fa1-82fc-6b639c4e7710"
+        responses.add(responses.POST,
+                      "http://seed-scheduler/api/v1/schedule/",
+                      json={"id": scheduler_schedule_id},
+                      status=201, content_type='application/json')
+        responses.add(responses.PATCH,
+                      "http://seed-scheduler/api/v1/schedule/%s/" % (
+                          scheduler_schedule_id,),
+                      json={"id": scheduler_schedule_id},
+                      status=200, content_type='application/json')
+
+        # Execute
+        schedule = Schedule.objects.create(minute="0", hour="8")
+        schedule = Schedule.objects.get(id=schedule.id)
+        schedule.hour = "9"
+        schedule.save()
+        # delete() clears the id
+        schedule_id = schedule.id
+        schedule.delete()
+
+        # Check
+        self.assertEqual(schedule.scheduler_schedule_id,
+                         scheduler_schedule_id)
+        created, updated, disabled = [
+            json.loads(call.request.body) for call in responses.calls]
+        self.assertEqual(created["cron_definition"], "0 8 * * *")
+        self.assertTrue(created["endpoint"].endswith(
+            "/schedule/%s/send" % schedule_id))
+        self.assertEqual(updated["cron_definition"], "0 9 * * *")
+        self.assertEqual(disabled, {"enabled": False})
+
+    @responses.activate
+    def test_schedule_send_endpoint(self):
+        # Setup
+        existing = self.make_subscription()
+        self.make_messages(self.messageset, 2)
+        self.mock_identity_lookups(existing.identity)
+        self.mock_outbound()
+
+        # Execute
+        response = self.client.post(
+            '/api/v1/subscriptions/schedule/%s/send' % self.schedule.id,
+            content_type='application/json')
+
+        # Check
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(
+            Subscription.objects.get(id=existing.id).next_sequence_number, 2)
+
+    def test_schedule_send_endpoint_missing_schedule(self):
+        # Execute
+        response = self.client.post(
+            '/api/v1/subscriptions/schedule/%s/send' % (
+                self.schedule.id + 1000,),
+            content_type='application/json')
+
+        # Check
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.json()["accepted"], False)
+
+    @responses.activate
+    @override_settings(SUBSCRIPTION_DISPATCH_MODE="schedule")
+    def test_new_subscription_not_scheduled_remotely(self):
+        # Setup
+        self._connect_post_save_hook()
+
+        # Execute
+        self.make_subscription()
+
+        # Check
+        self.assertEqual(len(responses.calls), 0)
+        self._disconnect_post_save_hook()
+
+
+class TestSendMessageBatchTask(AuthenticatedAPITestCase):
+
+    @responses.activate
+    def test_send_message_batch(self):
+        # Setup
+        first = self.make_subscription()
+        welcome = self.make_subscription_welcome()
+        last = self.make_subscription()
+        last.next_sequence_number = 2
+        last.save()
+        busy = self.make_subscription()
+        busy.process_status = 1
+        busy.save()
+        self.make_messages(self.messageset, 2)
+        self.mock_identity_lookups(first.identity)
+        self.mock_outbound()
+
+        # Execute
+        result = send_next_message_batch.apply_async(args=[[
+            str(first.id), str(welcome.id), str(last.id), str(busy.id)]])
+
+        # Check
+        self.assertEqual(result.get(), "3 sent, 0 errored, 0 skipped")
+        first = Subscription.objects.get(id=first.id)
+        self.assertEqual(first.next_sequence_number, 2)
+        self.assertEqual(first.process_status, 0)
+        welcome = Subscription.objects.get(id=welcome.id)
+        self.assertEqual(welcome.next_sequence_number, 2)
+        self.assertEqual(welcome.process_status, 0)
+        self.assertEqual(welcome.metadata["prepend_next_delivery"], None)
+        last = Subscription.objects.get(id=last.id)
+        self.assertEqual(last.next_sequence_number, 2)
+        self.assertEqual(last.completed, True)
+        self.assertEqual(last.active, False)
+        self.assertEqual(last.process_status, 2)
+        busy = Subscription.objects.get(id=busy.id)
+        self.assertEqual(busy.next_sequence_number, 1)
+        self.assertEqual(busy.process_status, 1)
+
+        outbound = [json.loads(call.request.body) for call in responses.calls
+                    if call.request.method == 'POST']
+        self.assertEqual(sorted(o["content"] for o in outbound), [
+            "This is message 1",
+            "This is message 2",
+            "Welcome to your messages!\nThis is message 1",
+        ])
+
+    @responses.activate
+    def test_send_message_batch_counts_whole_messageset(self):
+        # Setup
+        middle = self.make_subscription()
+        middle.next_sequence_number = 2
+        middle.save()
+        self.make_messages(self.messageset, 3)
+        self.mock_identity_lookups(middle.identity)
+        self.mock_outbound()
+
+        # Execute
+        result = send_next_message_batch.apply_async(args=[[
+            str(middle.id)]])
+
+        # Check
+        self.assertEqual(result.get(), "1 sent, 0 errored, 0 skipped")
+        middle = Subscription.objects.get(id=middle.id)
+        self.assertEqual(middle.next_sequence_number, 3)
+        self.assertEqual(middle.completed, False)
+        self.assertEqual(middle.process_status, 0)
+
+    @responses.activate
+    def test_send_message_batch_outbound_rejected(self):
+        # Setup
+        existing = self.make_subscription_welcome()
+        self.make_messages(self.messageset, 2)
+        self.mock_identity_lookups(existing.identity)
+        responses.add(
+            responses.POST,
+            "http://seed-message-sender/api/v1/outbound/",
+            json={"detail": "error"},
+            status=500, content_type='application/json'
+        )
+
+        # Execute
+        result = send_next_message_batch.apply_async(args=[[
+            str(existing.id)]])
+
+        # Check
+        self.assertEqual(result.get(), "0 sent, 0 errored, 1 skipped")
+        existing = Subscription.objects.get(id=existing.id)
+        self.assertEqual(existing.next_sequence_number, 1)
+        self.assertEqual(existing.process_status, 0)
+        self.assertEqual(existing.metadata["prepend_next_delivery"],
+                         "Welcome to your messages!")
+
+    @responses.activate
+    def test_send_due_messages_command(self):
+        # Setup
+        first = self.make_subscription()
+        last = self.make_subscription()
+        last.next_sequence_number = 2
+        last.save()
+        self.make_messages(self.messageset, 2)
+        self.mock_identity_lookups(first.identity)
+        self.mock_outbound()
+        out = StringIO()
+
+        # Execute
+        call_command("send_due_messages", str(self.schedule.id),
+                     "--batch-size", "1", stdout=out)
+
+        # Check
+        self.assertEqual(out.getvalue().splitlines(), [
+            "1 sent, 0 errored, 0 skipped",
+            "1 sent, 0 errored, 0 skipped",
+            "Processed 2 subscriptions",
+        ])
+        first = Subscription.objects.get(id=first.id)
+        self.assertEqual(first.next_sequence_number, 2)
+        self.assertEqual(first.process_status, 0)
+        last = Subscription.objects.get(id=last.id)
+        self.assertEqual(last.completed, True)
+        self.assertEqual(last.process_status, 2)
+
+    @override_settings(HTTP_POOL_SIZE=10)
+    def test_send_due_messages_concurrency_over_pool_size(self):
+        self.assertRaises(
+            CommandError, call_command, "send_due_messages",
+            str(self.schedule.id), "--concurrency", "11")
+
+    @responses.activate
+    def test_send_message_batch_missing_message(self):
+        # Setup
+        existing = self.make_subscription()
+
+        # Execute
+        result = send_next_message_batch.apply_async(args=[[
+            str(existing.id)]])
+
+        # Check
+        self.assertEqual(result.get(), "0 sent, 0 errored, 1 skipped")
+        existing = Subscription.objects.get(id=existing.id)
+        self.assertEqual(existing.next_sequence_number, 1)
+        self.assertEqual(existing.process_status, 0)
+        self.assertEqual(len(responses.calls), 0)
+
+
+@override_settings(SUBSCRIPTION_FUSED_POST_SEND=True)
+class TestFusedPostSend(AuthenticatedAPITestCase):
+
+    @responses.activate
+    def test_send_advances_subscription(self):
+        # Setup
+        existing = self.make_subscription()
+        self.make_messages(self.messageset, 2)
+        self.mock_identity_lookups(existing.identity)
+        self.mock_outbound()
+
+        # Execute
+        result = send_next_message.apply_async(args=[str(existing.id)])
+
+        # Check
+        self.assertEqual(
+            result.get(), "Message queued for send. ID: "
+            "<c7f3c839-2bf5-42d1-86b9-ccb886645fb4>")
+        d = Subscription.objects.get(id=existing.id)
+        self.assertEqual(d.next_sequence_number, 2)
+        self.assertEqual(d.process_status, 0)
+        self.assertEqual(d.active, True)
+        self.assertEqual(d.completed, False)
+
+    @responses.activate
+    def test_send_completes_subscription(self):
+        # Setup
+        next_set = MessageSet.objects.create(
+            short_name='messageset_next', default_schedule=self.schedule)
+        self.messageset.next_set = next_set
+        self.messageset.save()
+        existing = self.make_subscription()
+        existing.next_sequence_number = 2
+        existing.save()
+        self.make_messages(self.messageset, 2)
+        self.mock_identity_lookups(existing.identity)
+        self.mock_outbound()
+
+        # Execute
+        send_next_message.apply_async(args=[str(existing.id)])
+
+        # Check
+        d = Subscription.objects.get(id=existing.id)
+        self.assertEqual(d.next_sequence_number, 2)
+        self.assertEqual(d.process_status, 2)
+        self.assertEqual(d.active, False)
+        self.assertEqual(d.completed, True)
+        newsub = Subscription.objects.get(messageset=next_set)
+        self.assertEqual(newsub.identity, existing.identity)
+        self.assertEqual(newsub.next_sequence_number, 1)
+        self.assertEqual(newsub.active, True)
+
+
+class TestIdentityCache(AuthenticatedAPITestCase):
+
+    identity = "8646b7bc-b511-4965-a90b-e1145e398703"
+
+    def mock_address_lookup(self, results):
+        responses.add(
+            responses.GET,
+            "http://seed-identity-store/api/v1/identities/%s/addresses/msisdn?default=True" % (self.identity, ),  # noqa
+            json={
+                "count": len(results),
+                "next": None,
+                "previous": None,
+                "results": results
+            },
+            status=200, content_type='application/json',
+            match_querystring=True
+        )
+
+    @responses.activate
+    def test_identity_cached(self):
+        # Setup
+        responses.add(
+            responses.GET,
+            "http://seed-identity-store/api/v1/identities/%s/" % (
+                self.identity, ),
+            json={"id": self.identity, "details": {}},
+            status=200, content_type='application/json',
+        )
+
+        # Execute
+        first = utils.get_identity(self.identity)
+        second = utils.get_identity(self.identity)
+
+        # Check
+        self.assertEqual(first, {"id": self.identity, "details": {}})
+        self.assertEqual(second, first)
+        self.assertEqual(len(responses.calls), 1)
+
+    @responses.activate
+    def test_identity_address_cached(self):
+        # Setup
+        self.mock_address_lookup([{"address": "+2345059992222"}])
+
+        # Execute
+        first = utils.get_identity_address(self.identity)
+        second = utils.get_identity_address(self.identity)
+
+        # Check
+        self.assertEqual(first, "+2345059992222")
+        self.assertEqual(second, "+2345059992222")
+        self.assertEqual(len(responses.calls), 1)
+
+    @responses.activate
+    def test_missing_identity_address_cached(self):
+        # Setup
+        self.mock_address_lookup([])
+
+        # Execute
+        first = utils.get_identity_address(self.identity)
+        second = utils.get_identity_address(self.identity)
+
+        # Check
+        self.assertEqual(first, None)
+        self.assertEqual(second, None)
+        self.assertEqual(len(responses.calls), 1)
+
+    @responses.activate
+    def test_get_identity_addresses(self):
+        # Setup
+        other = "3f7c8851-5204-43f7-af7f-005059993333"
+        missing = "a9ba1f8c-83ad-4f7e-9b87-d3b3f4f3b7d1"
+        responses.add(
+            responses.GET,
+            "http://seed-identity-store/api/v1/identities/%s/" % (
+                self.identity, ),
+            json={"id": self.identity, "details": {}},
+            status=200, content_type='application/json',
+        )
+        responses.add(
+            responses.GET,
+            "http://seed-identity-store/api/v1/identities/%s/" % (other, ),
+            json={"id": other, "details": {},
+                  "communicate_through": self.identity},
+            status=200, content_type='application/json',
+        )
+        self.mock_address_lookup([{"address": "+2345059992222"}])
+
+        # Execute
+        addresses = utils.get_identity_addresses(
+            [self.identity, other, self.identity, missing])
+
+        # Check
+        self.assertEqual(addresses, {
+            self.identity: "+2345059992222",
+            other: "+2345059992222",
+        })
+        # three identities, one of them not found, and one shared address
+        self.assertEqual(len(responses.calls), 4)
+
+        # Everything found is cached
+        utils.get_identity_addresses([self.identity, other])
+        self.assertEqual(len(responses.calls), 4)
+
+    @responses.activate
+    def test_invalidate_identity(self):
+        # Setup
+        self.mock_address_lookup([{"address": "+2345059992222"}])
+        utils.get_identity_address(self.identity)
+
+        # Execute
+        utils.invalidate_identity(self.identity)
+        utils.get_identity_address(self.identity)
+
+        # Check
+        self.assertEqual(len(responses.calls), 2)
+
+    @responses.activate
+    def test_invalidate_identity_endpoint(self):
+        # Setup
+        self.mock_address_lookup([{"address": "+2345059992222"}])
+        utils.get_identity_address(self.identity)
+
+        # Execute
+        response = self.client.post(
+            '/api/v1/identities/%s/invalidate' % self.identity)
+        utils.get_identity_address(self.identity)
+
+        # Check
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.json(), {"accepted": True})
+        self.assertEqual(len(responses.calls), 2)
+
+
+class TestSessions(TestCase):
+
+    def test_session_shared_per_service(self):
+        session = utils.get_session("foo")
+        self.assertIs(utils.get_session("foo"), session)
+        self.assertIsNot(utils.get_session("bar"), session)
+
+    def test_session_configured(self):
+        session = utils.get_session("foo")
+        adapter = session.get_adapter("http://example.com/")
+        self.assertEqual(adapter._pool_maxsize, settings.HTTP_POOL_SIZE)
+        self.assertEqual(adapter.max_retries.total, settings.HTTP_MAX_RETRIES)
+        self.assertEqual(session.timeout, (settings.HTTP_CONNECT_TIMEOUT,
+                                           settings.HTTP_READ_TIMEOUT))
+
+
+class TestDeactivateSubscription(AuthenticatedAPITestCase):
+
+    @responses.activate
+    def test_deactivation_deactivates_schedule(self):
+        # Setup
+        schedule_id = "6455245a-028b-4fa1-82fc-6b639c4e7710"
+        sub = self.make_subscription()
+        sub.metadata["scheduler_schedule_id"] = schedule_id
+        sub.save()
+        self._connect_post_save_hook()
+
+        # mock schedule update
+        responses.add(
+            responses.PATCH,
+            "http://seed-scheduler/api/v1/schedule/%s/" % schedule_id,
+            json.dumps({"enabled": False}),
+            status=200, content_type='application/json')
+
+        # Execute
+        sub.active = False
+        sub.save()
+        sub.save()
+        # Check
+        self.assertEqual(len(responses.calls), 1)
+        self._disconnect_post_save_hook()
+
+
+class TestSubscriptionSaveHandling(AuthenticatedAPITestCase):
+
+    def mock_schedule_disable(self, subscription):
+        schedule_id = "6455245a-028b-4fa1-82fc-6b639c4e7710"
+        Subscription.objects.filter(id=subscription.id).update(
+            metadata={"scheduler_schedule_id": schedule_id})
+        responses.add(
+            responses.PATCH,
+            "http://seed-scheduler/api/v1/schedule/%s/" % schedule_id,
+            json.dumps({"enabled": False}),
+            status=200, content_type='application/json')
+
+    @responses.activate
+    def test_completing_claimed_subscription_disables_once(self):
+        # Setup
+        existing = self.make_subscription()
+        self.mock_schedule_disable(existing)
+        self._connect_post_save_hook()
+        subscription = Subscription.objects.claim(existing.id)
+
+        # Execute
+        subscription.completed = True
+        subscription.active = False
+        subscription.process_status = 2
+        subscription.save()
+        subscription.save()
+        loaded = Subscription.objects.get(id=existing.id)
+        loaded.metadata["source"] = "changed"
+        loaded.save()
+
+        # Check
+        self.assertEqual(len(responses.calls), 1)
+        self._disconnect_post_save_hook()
+
+    @responses.activate
+    def test_saves_without_transitions_do_nothing(self):
+        # Setup
+        existing = self.make_subscription()
+        self._connect_post_save_hook()
+
+        # Execute
+        subscription = Subscription.objects.get(id=existing.id)
+        subscription.next_sequence_number = 2
+        subscription.save()
+        subscription.process_status = 0
+        subscription.save()
+
+        # Check
+        self.assertEqual(len(responses.calls), 0)
+        self._disconnect_post_save_hook()
+
+
+@override_settings(SUBSCRIPTION_COUNTERS=True,
+                   SUBSCRIPTION_DISPATCH_MODE="schedule")
+class TestSubscriptionCounters(AuthenticatedAPITestCase):
+
+    def assertCounts(self, **expected):
+        for bucket, count in expected.items():
+            self.assertEqual(
+                counters.get_count(bucket, self.messageset.id), count,
+                "%s count" % bucket)
+
+    def test_counters_follow_saves(self):
+        # Setup
+        self._connect_post_save_hook()
+
+        # Execute
+        first = self.make_subscription()
+        second = self.make_subscription()
+        third = self.make_subscription()
+        first = Subscription.objects.get(id=first.id)
+        first.completed = True
+        first.active = False
+        first.process_status = 2
+        first.save()
+        second = Subscription.objects.get(id=second.id)
+        second.process_status = -1
+        second.save()
+        second.save()
+        third.delete()
+
+        # Check
+        self.assertCounts(created=2, active=1, completed=1, broken=1)
+        self._disconnect_post_save_hook()
+
+    def test_advance_subscriptions_counts_completions(self):
+        # Setup
+        existing = self.make_subscription()
+        self.make_subscription()
+        Subscription.objects.filter(id=existing.id).update(
+            process_status=1)
+        self.make_messages(self.messageset, 1)
+        tasks.reconcile_subscription_counters.apply_async()
+        self.assertCounts(created=2, active=2, completed=0)
+
+        # Execute
+        tasks.advance_subscriptions(
+            [Subscription.objects.get(id=existing.id)])
+
+        # Check
+        self.assertCounts(created=2, active=1, completed=1)
+        self.assertEqual(counters.count("active"), 1)
+
+    def test_advance_subscriptions_completes_once(self):
+        # Setup
+        next_set = MessageSet.objects.create(
+            short_name='messageset_next', default_schedule=self.schedule)
+        self.messageset.next_set = next_set
+        self.messageset.save()
+        existing = self.make_subscription()
+        Subscription.objects.filter(id=existing.id).update(
+            process_status=1)
+        self.make_messages(self.messageset, 1)
+        tasks.reconcile_subscription_counters.apply_async()
+        in_process = Subscription.objects.get(id=existing.id)
+
+        # Execute
+        tasks.advance_subscriptions([in_process])
+        tasks.advance_subscriptions([in_process])
+
+        # Check
+        self.assertEqual(
+            Subscription.objects.filter(messageset=next_set).count(), 1)
+        self.assertCounts(created=1, active=0, completed=1)
+
+    def test_reconcile(self):
+        # Setup
+        self.make_subscription()
+        broken = self.make_subscription()
+        broken.process_status = -1
+        broken.save()
+        counters.apply_deltas({(self.messageset.id, "active"): 5})
+
+        # Execute
+        result = tasks.reconcile_subscription_counters.apply_async()
+
+        # Check
+        self.assertEqual(result.get(), "4 counters corrected")
+        self.assertCounts(created=2, active=2, completed=0, broken=1)
+        result = tasks.reconcile_subscription_counters.apply_async()
+        self.assertEqual(result.get(), "0 counters corrected")
+
+
+class TestSubscriptionIndexes(TestCase):
+
+    def test_indexes(self):
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(
+                cursor, Subscription._meta.db_table)
+        indexed = [c["columns"] for c in constraints.values() if c["index"]]
+        self.assertIn(["identity"], indexed)
+        self.assertIn(["messageset_id", "active"], indexed)
+        for name in ("subscriptions_subscription_due",
+                     "subscriptions_subscription_idle",
+                     "subscriptions_subscription_status"):
+            self.assertIn(name, constraints)
+
+    def test_benchmark_command(self):
+        out = StringIO()
+
+        call_command("benchmark_subscription_indexes", "--rows", "1000",
+                     stdout=out)
+
+        lines = out.getvalue().strip().split("\n")
+        self.assertEqual(lines[0], "Generating 1000 subscriptions")
+        self.assertEqual(len(lines), 6)
+        self.assertTrue(lines[2].startswith("identity filter"))
+
+
+class TestMetricsAPI(AuthenticatedAPITestCase):
+
+    def test_metrics_read(self):
+        # Setup
+        # Execute
+        response = self.client.get('/api/metrics/',
+                                   content_type='application/json')
+        # Check
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response.data["metrics_available"], [
+                'subscriptions.created.sum',
+                'subscriptions.send_next_message_errored.sum',
+                'subscriptions.active.last',
+                'subscriptions.created.last',
+                'subscriptions.broken.last',
+                'subscriptions.completed.last',
+                'subscriptions.messageset_one.active.last',
+                'subscriptions.messageset_two.active.last'
+            ]
+        )
+
+    @responses.activate
+    def test_post_metrics(self):
+        # Setup
+        # deactivate Testsession for this test
+        self.session = None
+        responses.add(responses.POST,
+                      "http://metrics-url/metrics/",
+                      json={"foo": "bar"},
+                      status=200, content_type='application/json')
+        # Execute
+        response = self.client.post('/api/metrics/',
+                                    content_type='application/json')
+        # Check
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data["scheduled_metrics_initiated"], True)
+
+
+class TestMetrics(AuthenticatedAPITestCase):
+
+    def check_request(
+            self, request, method, params=None, data=None, headers=None):
+        self.assertEqual(request.method, method)
+        if params is not None:
+            url = urlparse.urlparse(request.url)
+            qs = urlparse.parse_qsl(url.query)
+            self.assertEqual(dict(qs), params)
+        if headers is not None:
+            for key, value in headers.items():
+                self.assertEqual(request.headers[key], value)
         if data is None:
             self.assertEqual(request.body, None)
         else:
@@ -1419,11 +2658,12 @@ class TestMetrics(AuthenticatedAPITestCase):
         self.assertEqual(result.get(),
                          "Fired metric <foo.last> with value <1.0>")
 
+    @override_settings(SUBSCRIPTION_DISPATCH_MODE="schedule")
     def test_created_metrics(self):
         # Setup
         adapter = self._mount_session()
         # reconnect metric post_save hook
-        post_save.connect(fire_metrics_if_new, sender=Subscription)
+        post_save.connect(handle_subscription_save, sender=Subscription)
 
         # Execute
         self.make_subscription()
@@ -1434,15 +2674,16 @@ class TestMetrics(AuthenticatedAPITestCase):
             data={"subscriptions.created.sum": 1.0}
         )
         # remove post_save hooks to prevent teardown errors
-        post_save.disconnect(fire_metrics_if_new, sender=Subscription)
+        self._disconnect_post_save_hook()
 
     @responses.activate
+    @override_settings(SUBSCRIPTION_DISPATCH_MODE="schedule")
     def test_multiple_created_metrics(self):
         # Setup
         # deactivate Testsession for this test
         self.session = None
         # reconnect metric post_save hook
-        post_save.connect(fire_metrics_if_new, sender=Subscription)
+        self._connect_post_save_hook()
         # add metric post response
         responses.add(responses.POST,
                       "http://metrics-url/metrics/",
@@ -1456,7 +2697,38 @@ class TestMetrics(AuthenticatedAPITestCase):
         # Check
         self.assertEqual(len(responses.calls), 2)
         # remove post_save hooks to prevent teardown errors
-        post_save.disconnect(fire_metrics_if_new, sender=Subscription)
+        self._disconnect_post_save_hook()
+
+    @responses.activate
+    @override_settings(SUBSCRIPTION_DISPATCH_MODE="schedule",
+                       METRICS_BUFFER_INTERVAL=60)
+    def test_buffered_created_metrics(self):
+        # Setup
+        self.session = None
+        self._connect_post_save_hook()
+        responses.add(responses.POST,
+                      "http://metrics-url/metrics/",
+                      json={"foo": "bar"},
+                      status=200, content_type='application/json')
+
+        # Execute
+        self.make_subscription()
+        self.make_subscription()
+        metrics.increment('subscriptions.send_next_message_errored.sum')
+        self.assertEqual(len(responses.calls), 0)
+        flushed = metrics.buffer.flush()
+
+        # Check
+        expected = {
+            "subscriptions.created.sum": 2.0,
+            "subscriptions.send_next_message_errored.sum": 1.0,
+        }
+        self.assertEqual(flushed, expected)
+        self.assertEqual(len(responses.calls), 1)
+        self.assertEqual(json.loads(responses.calls[0].request.body),
+                         expected)
+        self.assertEqual(metrics.buffer.flush(), {})
+        self._disconnect_post_save_hook()
 
     @responses.activate
     def test_scheduled_metrics(self):
@@ -1472,9 +2744,64 @@ class TestMetrics(AuthenticatedAPITestCase):
         # Execute
         result = scheduled_metrics.apply_async()
         # Check
-        self.assertEqual(result.get(), "5 Scheduled metrics launched")
-        # fire_messagesets_tasks fires two metrics, therefore extra call
-        self.assertEqual(len(responses.calls), 6)
+        self.assertEqual(result.get(), "1 Scheduled metrics launched")
+        # fire_subscription_metrics fires all its metrics at once
+        self.assertEqual(len(responses.calls), 1)
+
+    def test_fire_subscription_metrics(self):
+        # Setup
+        adapter = self._mount_session()
+        self.make_subscription()
+        self.make_subscription()
+        sub = self.make_subscription()
+        sub.active = False
+        sub.completed = True
+        sub.save()
+        broken = self.make_subscription_audio()
+        broken.process_status = -1
+        broken.save()
+
+        # Execute
+        with self.assertNumQueries(1):
+            result = tasks.fire_subscription_metrics.run()
+
+        # Check
+        self.assertEqual(result, "Fired 6 metrics")
+        self.check_request(
+            adapter.request, 'POST',
+            data={
+                "subscriptions.active.last": 3.0,
+                "subscriptions.created.last": 4.0,
+                "subscriptions.broken.last": 1.0,
+                "subscriptions.completed.last": 1.0,
+                "subscriptions.messageset_one.active.last": 2.0,
+                "subscriptions.messageset_two.active.last": 1.0,
+            }
+        )
+
+    @override_settings(SUBSCRIPTION_COUNTERS=True)
+    def test_fire_subscription_metrics_from_counters(self):
+        # Setup
+        adapter = self._mount_session()
+        self.make_subscription()
+        tasks.reconcile_subscription_counters.run()
+
+        # Execute
+        result = tasks.fire_subscription_metrics.run()
+
+        # Check
+        self.assertEqual(result, "Fired 6 metrics")
+        self.check_request(
+            adapter.request, 'POST',
+            data={
+                "subscriptions.active.last": 1.0,
+                "subscriptions.created.last": 1.0,
+                "subscriptions.broken.last": 0.0,
+                "subscriptions.completed.last": 0.0,
+                "subscriptions.messageset_one.active.last": 1.0,
+                "subscriptions.messageset_two.active.last": 0.0,
+            }
+        )
 
     def test_fire_active_last(self):
         # Setup
@@ -9,10 +9,16 @@ router.register(r'subscriptions', views.SubscriptionViewSet)
 # Additionally, we include login URLs for the browseable API.
 urlpatterns = [
     url(r'^api/v1/', include(router.urls)),
+    url(r'^api/v1/subscriptions/schedule/(?P<schedule_id>\d+)/send$',
+        views.ScheduleSend.as_view()),
     url(r'^api/v1/subscriptions/(?P<subscription_id>.+)/send$',
         views.SubscriptionSend.as_view()),
     url(r'^api/v1/subscriptions/request$',
         views.SubscriptionRequest.as_view()),
+    url(r'^api/v1/subscriptions/bulk$',
+        views.SubscriptionBulkImport.as_view()),
+    url(r'^api/v1/identities/(?P<identity_id>[^/]+)/invalidate$',
+        views.IdentityInvalidate.as_view()),
     url(r'^api/v1/user/token/$', views.UserView.as_view(),
         name='create-user-token'),
 ]
@@ -1,15 +1,24 @@
 from rest_framework import viewsets, status
+from rest_framework.decorators import list_route
 from rest_framework.permissions import IsAuthenticated, IsAdminUser
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.authtoken.models import Token
 from django.core.exceptions import ObjectDoesNotExist
+from django.http import StreamingHttpResponse
 from django.contrib.auth.models import User
 
 from .models import Subscription
-from .serializers import SubscriptionSerializer, CreateUserSerializer
-from .tasks import send_next_message, scheduled_metrics
-from seed_stage_based_messaging.utils import get_available_metrics
+from contentstore.models import Schedule
+from .serializers import (SubscriptionSerializer, SubscriptionRowSerializer,
+                          CreateUserSerializer)
+from .export import WRITERS, iter_rows
+from .imports import READERS, InvalidImport, import_subscriptions
+from .tasks import send_next_message, send_schedule, scheduled_metrics
+from seed_stage_based_messaging.pagination import (
+    LimitOffsetOrKeysetPagination)
+from seed_stage_based_messaging.utils import (get_available_metrics,
+                                              invalidate_identity)
 
 
 class SubscriptionViewSet(viewsets.ModelViewSet):
@@ -19,9 +28,43 @@ class SubscriptionViewSet(viewsets.ModelViewSet):
     permission_classes = (IsAuthenticated,)
     queryset = Subscription.objects.all()
     serializer_class = SubscriptionSerializer
+    pagination_class = LimitOffsetOrKeysetPagination
     filter_fields = ('identity', 'messageset_id', 'lang', 'active',
                      'completed', 'schedule', 'process_status', 'metadata',)
 
+    def list(self, request, *args, **kwargs):
+        """ Lists subscriptions from values() rows, with each url built from
+            one reversed for the request. Gives the same response as
+            SubscriptionSerializer for a fraction of the work per row.
+        """
+        queryset = self.filter_queryset(self.get_queryset()).values(
+            *SubscriptionRowSerializer.value_fields)
+        serializer = SubscriptionRowSerializer.for_request(
+            request, format=self.format_kwarg)
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(
+                [serializer.to_representation(row) for row in page])
+        return Response(
+            [serializer.to_representation(row) for row in queryset])
+
+    @list_route(methods=['get'])
+    def export(self, request):
+        """ Streams every subscription matching the list filters, as JSON
+            lines or, with output=csv, as CSV
+        """
+        output = request.query_params.get("output", "jsonl")
+        if output not in WRITERS:
+            return Response({"reason": "Unsupported output %s" % output},
+                            status=400)
+        content_type, write = WRITERS[output]
+        rows = iter_rows(self.filter_queryset(self.get_queryset()))
+        response = StreamingHttpResponse(write(rows),
+                                         content_type=content_type)
+        response["Content-Disposition"] = \
+            'attachment; filename="subscriptions.%s"' % output
+        return response
+
 
 class SubscriptionSend(APIView):
 
@@ -46,6 +89,38 @@ class SubscriptionSend(APIView):
         return Response(accepted, status=status)
 
 
+class ScheduleSend(APIView):
+
+    """ Triggers a send for all the subscriptions on a schedule, called by
+        the scheduler in the "shared" dispatch mode
+    """
+    permission_classes = (IsAuthenticated,)
+
+    def post(self, request, *args, **kwargs):
+        schedule_id = kwargs["schedule_id"]
+        if Schedule.objects.filter(id=schedule_id).exists():
+            status = 201
+            accepted = {"accepted": True}
+            send_schedule.apply_async(args=[int(schedule_id)])
+        else:
+            status = 400
+            accepted = {"accepted": False,
+                        "reason": "Missing schedule in control"}
+        return Response(accepted, status=status)
+
+
+class IdentityInvalidate(APIView):
+
+    """ Drops an identity and its address from the identity cache, for the
+        identity store to call when an identity changes
+    """
+    permission_classes = (IsAuthenticated,)
+
+    def post(self, request, *args, **kwargs):
+        invalidate_identity(kwargs["identity_id"])
+        return Response({"accepted": True}, status=201)
+
+
 class SubscriptionRequest(APIView):
 
     """ Webhook listener for registrations now needing a subscription
@@ -70,6 +145,38 @@ class SubscriptionRequest(APIView):
             return Response(subscription.errors, status=status)
 
 
+class SubscriptionBulkImport(APIView):
+
+    """ Creates subscriptions from a JSON lines (application/x-ndjson) or
+        CSV (text/csv) request body, in chunks
+    """
+    permission_classes = (IsAuthenticated,)
+
+    CONTENT_TYPES = {
+        "application/x-ndjson": "jsonl",
+        "application/jsonl": "jsonl",
+        "text/csv": "csv",
+    }
+
+    def post(self, request, *args, **kwargs):
+        content_type = request.META.get("CONTENT_TYPE", "")
+        content_type = content_type.split(";")[0].strip()
+        if content_type not in self.CONTENT_TYPES:
+            return Response({
+                "accepted": False,
+                "reason": "Unsupported content type %s" % content_type
+            }, status=415)
+
+        rows = READERS[self.CONTENT_TYPES[content_type]](request.stream or [])
+        try:
+            created, errors = import_subscriptions(rows)
+        except InvalidImport as e:
+            return Response({"accepted": False, "reason": str(e)},
+                            status=400)
+        return Response({"accepted": True, "created": created,
+                         "errors": errors}, status=201)
+
+
 class UserView(APIView):
     """ API endpoint that allows users creation and returns their token.
     Only admin users can do this to avoid permissions escalation.